@@ -3,19 +3,25 @@ import logging
 
 from ccg_nlpy.core import view
 from utils.data_utils import count_outlinks
+from utils.outlinks_graph import OutlinksGraph
+from utils.pair_cache import shared_pair_cache, resource_key
 
 
 
 logger = logging.getLogger(__name__)
 
 class StarModel(object):
-    def __init__(self, outlinks_map=None, fb_relations_map=None, cooccurrence_map=None):
+    def __init__(self, outlinks_map=None, fb_relations_map=None, cooccurrence_map=None, pair_cache=None):
     
         self.m = 1
         self.k = 5
         self.w_unary = np.array([-0.5,-0.5])
         self.w_pairwise = np.array([0.05,0.10,0.15,0.20,0.25,0.25])
         self.outlinks_map = None
+        # link counts between the candidates of the document being annotated
+        self.link_counts = None
+        # feature vectors of title pairs, shared with CoherenceFeatureExtractor by default
+        self.pair_cache = pair_cache if pair_cache is not None else shared_pair_cache
 
         if outlinks_map is not None:
             self.outlinks_map = outlinks_map
@@ -37,6 +43,9 @@ class StarModel(object):
         n = len(candgen_labels_to_scores)
         indices = np.arange(n, -1, -1)
         logger.info("Lengths of labelsToScores, constituents: " + str(n) + "," + str(len(candgen_cons)))
+        if isinstance(self.outlinks_map, OutlinksGraph):
+            self.link_counts = self.outlinks_map.link_counts(
+                title for mention in candgen_labels_to_scores if mention for title in mention)
         for i in range(n):
             # mi is the current mention for which to perform coherence
             mi = candgen_labels_to_scores[i]
@@ -76,6 +85,7 @@ class StarModel(object):
 
         coherence_view = view.View(coh_view_json,ta.get_tokens)
         ta.view_dictionary["COHERENCE"] = coherence_view
+        self.link_counts = None
 
     
     """
@@ -147,11 +157,18 @@ class StarModel(object):
         @return: vector representation of pairwise similarity of two titles
     """
     def feature_vec(self, yi, yj):
-        # TODO: some caching here, probably
+        namespace = ("star", self.m, resource_key(self.outlinks_map))
+        return self.pair_cache.get_or_compute(namespace, yi, yj,
+                                              lambda: self._compute_feature_vec(yi, yj))
+
+    def _compute_feature_vec(self, yi, yj):
         fv = np.zeros(self.m)
-        num_outlinks = \
-            count_outlinks(yi,yj,self.outlinks_map) + \
-            count_outlinks(yj,yi,self.outlinks_map)
+        if self.link_counts is not None and yi in self.link_counts and yj in self.link_counts:
+            num_outlinks = self.link_counts.count(yi, yj)
+        else:
+            num_outlinks = \
+                count_outlinks(yi,yj,self.outlinks_map) + \
+                count_outlinks(yj,yi,self.outlinks_map)
         if num_outlinks >= 5:
             fv[4] = 1
         elif num_outlinks == 4:
@@ -17,11 +17,22 @@ class StarModel:
     def range_not_j(self, j, m):
         return tf.setdiff1d(tf.range(m), [j])[1]
 
+    def pair_scores(self, pair_feats):
+        """Weighted sum of the pairwise features, of shape mx(m-1)xcxc.
+        pair_feats is either the dense mx(m-1)xcxcxp tensor or a
+        tf.SparseTensor of it, see write_tfrecords.decode_sparse, in which
+        case only its nonzero entries are multiplied."""
+        if isinstance(pair_feats, tf.SparseTensor):
+            indices = pair_feats.indices
+            weighted = pair_feats.values * tf.gather(self.pair_weights, indices[:, 4])
+            return tf.scatter_nd(indices[:, :4], weighted, pair_feats.dense_shape[:4])
+        return tf.einsum('nmijs,s->nmij', pair_feats, self.pair_weights)
+
     def loss(self, single_feats, pair_feats, truth):
         # multiply by weights
         tf.Print(single_feats, [single_feats])
         single_multiplied = tf.einsum('nis,s->ni', single_feats, self.single_weights)
-        pair_multiplied = tf.einsum('nmijs,s->nmij', pair_feats, self.pair_weights)
+        pair_multiplied = self.pair_scores(pair_feats)
         
         # calculate q_{i,j} = max_j s_{i,j} + s{j}
         # single_multiplied has shape mxc
@@ -58,7 +69,7 @@ class StarModel:
     def accuracy(self, single_feats, pair_feats, truth):
         # multiply by weights
         single_multiplied = tf.einsum('nis,s->ni', single_feats, self.single_weights)
-        pair_multiplied = tf.einsum('nmijs,s->nmij', pair_feats, self.pair_weights)
+        pair_multiplied = self.pair_scores(pair_feats)
 
         # calculate q_{i,j} = max_j s_{i,j} + s{j}
         # single_multiplied has shape mxc
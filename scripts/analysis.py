@@ -1,14 +1,16 @@
 from collections import defaultdict
-import pickle
 import operator
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.io_utils import APB_MIN, WLL_MIN, AUG_MIN
+from utils.kb_columns import ColumnarKB
 
 #GOLD_TAB = "il6_edl.tab"
 GOLD_TAB = "il5_edl.tab"
 
-APB_MIN = 20000001
-WLL_MIN = 30000001
-AUG_MIN = 71000001
-
 SEEN = defaultdict(lambda: False)
 COUNTS = {"GEO":0.0,"APB":0.0,"WLL":0.0,"AUG":0.0}
 TOTALS = defaultdict(int)
@@ -23,7 +25,9 @@ WIKI_TYPES = defaultdict(int)
 
 ET_GEO = defaultdict(lambda: defaultdict(int))
 
-KB = pickle.load(open("/home/cddunca2/lorelei2018/kb/kb.p","rb"))
+# columnar store built with utils/kb_columns.py, only the fields read below
+# are paged in
+KB = ColumnarKB("/home/cddunca2/lorelei2018/kb/columns/")
 MENTION_IN_WIKI = 0
 LINKABLE = 0
 
@@ -41,7 +45,7 @@ with open(GOLD_TAB,"r") as f:
             continue
         if "|" in kbid:
             kbid = kbid.split("|")[0]
-        exlink = KB[kbid][-1]
+        exlink = KB.get_field(kbid, "external_link", "")
         #links = exlink.split("|")
         #wiki_links = [link for link in links if "en.wikipedia" in link]
         kbid_i = int(kbid)
@@ -50,12 +54,13 @@ with open(GOLD_TAB,"r") as f:
             MENTION_IN_WIKI+=1
             WIKI_TYPES[typ]+=1
         if not SEEN[kbid_i]:
-            CTRY_CODE[KB[kbid][12]]+=1
+            country_code = KB.get_field(kbid, "country_code", "")
+            CTRY_CODE[country_code]+=1
             if "en.wikipedia" in exlink:
-                if KB[kbid][12] == "ET":
+                if country_code == "ET":
                     ET_WIKI += 1
-                    f_class = KB[kbid][7]
-                    f_code = KB[kbid][9]
+                    f_class = KB.get_field(kbid, "feature_class", "")
+                    f_code = KB.get_field(kbid, "feature_code", "")
                     ET_GEO[f_class][f_code]+=1
                 WIKI["enwiki"]+=1
             elif "wikipedia" in exlink:
@@ -0,0 +1,23 @@
+import logging
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.io_utils import build_outlinks_graph_file
+from utils.outlinks_graph import load_outlinks_graph
+
+"""
+    Converts outlinks.t2t to the binary graph loaded by io_utils.outlinks_graph.
+
+        python scripts/build_outlinks_graph.py outlinks.t2t [outlinks.t2t.graph]
+"""
+
+if __name__=="__main__":
+    logging.basicConfig(format=':%(levelname)s: %(message)s', level=logging.INFO)
+    graph_file = build_outlinks_graph_file(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    start = time.time()
+    graph = load_outlinks_graph(graph_file)
+    logging.info("%s opens in %.1fms, %d titles and %d edges",
+                 graph_file, 1000 * (time.time() - start), len(graph), graph.num_edges)
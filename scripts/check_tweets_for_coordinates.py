@@ -1,9 +1,21 @@
 import os
+import sys
 import json
 
-def check_tweets_for_coordinates(dr):
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+def check_tweets_for_coordinates(dr, kb=None, n=5):
+    """
+        Counts the tweets in a directory which have coordinates. If a kb is
+        given, the n kb entities closest to each tweet are printed as well.
+
+        @param: dr, directory of tweets serialized as json
+        @param: kb, optional io_utils.LORELEIKBLoader
+        @param: n, number of nearby entities to print per tweet
+    """
     t_ct = 0
     c_ct = 0
+    coords = []
     for filename in os.listdir(dr):
         if filename.endswith(".json"):
             t_ct+=1
@@ -13,10 +25,23 @@ def check_tweets_for_coordinates(dr):
             if coord != None:
                 c_ct+=1
                 print(coord)
+                # GeoJSON points are [longitude, latitude]
+                lon, lat = coord["coordinates"]
+                coords.append((filename, lat, lon))
     print("total tweets: %d"%t_ct)
     print("tweets with coords: %d"%c_ct)
 
-if __name__=="__main__":
-    import sys
-    check_tweets_for_coordinates(sys.argv[1])
+    if kb is not None and coords:
+        geo = kb.geo_index()
+        nearest = geo.nearest_many([(lat, lon) for _, lat, lon in coords], n)
+        for (filename, lat, lon), (eids, dists) in zip(coords, nearest):
+            print("%s (%f, %f)"%(filename, lat, lon))
+            for eid, dist in zip(eids, dists):
+                print("\t%d %s %.1fkm"%(eid, kb.kb[str(eid)].get("name", ""), dist))
 
+if __name__=="__main__":
+    kb = None
+    if len(sys.argv) > 2:
+        from utils.io_utils import LORELEIKBLoader
+        kb = LORELEIKBLoader(sys.argv[2])
+    check_tweets_for_coordinates(sys.argv[1], kb)
@@ -21,6 +21,8 @@ YEAR = sys.argv[1]
 #TA_DIR = "/shared/experiments/cddunca2/tac-nitish-pred-tas-"+YEAR+"-test/"
 TA_DIR = "/shared/experiments/cddunca2/tac-nitish-pred-tas-"+YEAR+"/"
 TFR = "data/tfr/nitish_"+YEAR+".tfrecord"
+# number of processes to extract features with
+NUM_WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else 1
 
 logger.info("Loading text annotations.")
 tas = get_ta_dir(TA_DIR)
@@ -48,5 +50,5 @@ print("accuracy: %f"%(correct/total))
 #
 #featureExtractor = CoherenceFeatureExtractor(4,11,max_cands)
 #logging.info("Writing TFRecord")
-#write_tfrecord(documents, TFR, featureExtractor)
+#write_tfrecord(documents, TFR, featureExtractor, num_workers=NUM_WORKERS)
 
@@ -0,0 +1,35 @@
+import logging
+
+"""
+    Hit/miss accounting shared by the caches, see kb_cache.CachedKB and
+    pair_cache.PairFeatureCache.
+"""
+
+class CacheStatsMixin:
+    """
+        Reports the counters of a cache. The class using it keeps hits,
+        misses, evictions, maxsize and its entries in cache, and names
+        itself in stats_name for the log.
+    """
+    stats_name = "cache"
+
+    def stats(self):
+        """
+            @return: dict of hits, misses, evictions, size, maxsize and hit_rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.cache),
+            "maxsize": self.maxsize,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def log_stats(self, name=None):
+        """Logs the counters of the cache."""
+        stats = self.stats()
+        logging.info("%s cache: %d hits, %d misses, %d evictions, %d/%d entries, hit rate %.3f",
+                     name or self.stats_name, stats["hits"], stats["misses"], stats["evictions"],
+                     stats["size"], stats["maxsize"], stats["hit_rate"])
@@ -8,7 +8,11 @@ import math
 import numpy as np
 import tensorflow as tf
 
-from .io_utils import id_to_title_map, title_to_id_map, load_pkl, outlinks
+from .io_utils import id_to_title_map, title_to_id_map, load_pkl, outlinks, outlinks_graph
+from .outlinks_graph import OutlinksGraph, off_diagonal
+from .freebase_relations import FreebaseRelationIndex
+from .resources import registry
+from .pair_cache import shared_pair_cache, titles_key
 from sqlitedict import SqliteDict
 
 
@@ -103,8 +107,12 @@ def get_num_freebase_rel(wid_tup, freebase_rel_map):
         two Wikipedia pages.
 
         @param: wid_tup, tuple of two Wikipedia page ids
+        @param: freebase_rel_map, dict pickled by preprocess.build_freebase_relations_dict
+                or a freebase_relations.FreebaseRelationIndex
         @return: the number of Freebase relations between the two pages
     """
+    if isinstance(freebase_rel_map, FreebaseRelationIndex):
+        return freebase_rel_map.count(*wid_tup)
     if wid_tup in freebase_rel_map:
         return freebase_rel_map[wid_tup]
     if wid_tup[::-1] in freebase_rel_map:
@@ -118,8 +126,11 @@ def count_outlinks(src, dest, outlinks_map):
 
         @param: src, the source title
         @param: dest, the destination title
+        @param: outlinks_map, map from io_utils.outlinks or an OutlinksGraph
         @return: the number of outlinks in Wikipedia form src to dest
     """
+    if isinstance(outlinks_map, OutlinksGraph):
+        return outlinks_map.count(src, dest)
     print(src)
     print(dest)
     # the title isn't in the outlinks map then it has no outlinks
@@ -134,13 +145,19 @@ def get_wikititle(kb, eid):
         Function for retrieving Wikipedia link(s) for a given
         entity from the LORELEI KB.
 
-        @param: kb, LORELEI KB please see io_utils.LORELEIKBLoader for details
+        @param: kb, LORELEI KB please see io_utils.LORELEIKBLoader for details,
+                    either the SQLite store or a kb_columns.ColumnarKB
         @param: eid, the entity id of the kb record
         @return: list of Wikipedia links which correspond to the record or None
                  if there are no Wikipedia pages for the record
     """
-    if "external_link" in kb[eid]:
-        links = kb[eid]["external_link"].split("|")
+    # the columnar store can read the one field without building the record
+    if hasattr(kb, "get_field"):
+        external_link = kb.get_field(eid, "external_link")
+    else:
+        external_link = kb[eid].get("external_link")
+    if external_link is not None:
+        links = external_link.split("|")
         wiki_link = [link for link in links if "en.wikipedia" in link]
         if len(wiki_link) == 0:
             return None
@@ -148,6 +165,33 @@ def get_wikititle(kb, eid):
             return wiki_link
     return None
 
+def unary_features(scores, mask):
+    """
+        Computes the unary features of candidates from their scores, see
+        CoherenceFeatureExtractor.init_unary_feature_matrix. The features
+        are identical to computing them one candidate at a time with
+        math.isclose and np.log.
+
+        @param: scores, array of candidate scores p_i(c)
+        @param: mask, boolean array of the same shape, False for padding
+        @return: array of the shape of scores plus a last axis of the 4
+                 features, 0 for padding
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    # math.isclose(s, 0.0, rel_tol=1e-9) only holds for s == 0
+    is_zero = mask & (scores == 0.0)
+    # math.isclose(s, 1, rel_tol=1e-9)
+    is_one = mask & ~is_zero & (np.abs(scores - 1.0) <= 1e-9 * np.maximum(np.abs(scores), 1.0))
+    other = mask & ~is_zero & ~is_one
+
+    features = np.zeros(scores.shape + (4,))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        features[...,0] = np.where(other, np.log(np.where(other, scores, 1.0)), 0.0)
+        features[...,1] = np.where(other, np.log(np.where(other, 1.0 - scores, 1.0)), 0.0)
+    features[...,2] = is_zero
+    features[...,3] = is_one
+    return features
+
 class Mention:
     """Class for maintaining the meta data associated with a mention in a document."""
 
@@ -213,7 +257,19 @@ class Document:
 class CoherenceFeatureExtractor:
     """Class for extracting features of entity linking document."""
 
-    def __init__(self, num_unary_features, num_pairwise_features, max_cands_per_mention):
+    def __init__(self, num_unary_features, num_pairwise_features, max_cands_per_mention, title_vocab=None,
+                 resources=None, pair_cache=None):
+        """
+            The outlinks, Freebase relations and title to id map are taken
+            from a resources.ResourceRegistry when they are first used.
+
+            @param: title_vocab, optional set of candidate titles, when given
+                    only the outlinks between these titles are loaded
+            @param: resources, registry to take the resources from, the
+                    process wide resources.registry by default
+            @param: pair_cache, pair_cache.PairFeatureCache for the pairwise
+                    features, shared with StarModel by default
+        """
         # the number of unary features in the model
         self.num_unary_features = num_unary_features
         # the number of pairwise features in the model
@@ -221,20 +277,54 @@ class CoherenceFeatureExtractor:
 
         # the maximum number of candidate titles per mention in a document
         self.max_cands_per_mention = max_cands_per_mention
-        
-        # used for outlinks feature
-        outlinks_file = "/shared/preprocessed/cddunca2/wikipedia/outlinks.t2t"
-        outlinks_map = outlinks(outlinks_file)
-        self.outlinks_map = outlinks_map
-        # used for freebase relations feature
-        self.fb_relations_map = load_pkl("/home/cddunca2/lorelei2018/resources/freebase_relations.pkl")
+
+        self.resources = resources if resources is not None else registry
+        self.title_vocab = title_vocab
+        # outlinks restricted to title_vocab, not shared with other extractors
+        self._outlinks_map = None
         # used for cooccurence feature
         self.cooccurrence_map = None
-        # map titles to wid
-        self.title_to_id_map = title_to_id_map()
+        # pairwise features of title pairs seen in earlier documents
+        self.pair_cache = pair_cache if pair_cache is not None else shared_pair_cache
+        # restricted outlinks give different features, so they're cached separately
+        self._title_vocab_key = titles_key(title_vocab)
 
     # end __init__
 
+    @property
+    def pair_namespace(self):
+        """Namespace of the pairwise features in the pair cache, which
+        identifies the resources and vocabulary they are computed from."""
+        return ("coherence", self.num_pairwise_features, self._title_vocab_key,
+                self.resources.identity("outlinks"), self.resources.identity("freebase_relations"),
+                self.resources.identity("titles"))
+
+    @property
+    def outlinks_map(self):
+        """used for outlinks feature"""
+        if self.title_vocab is None:
+            return self.resources.get("outlinks")
+        if self._outlinks_map is None:
+            self._outlinks_map = outlinks_graph(self.resources.path("outlinks"), self.title_vocab)
+        return self._outlinks_map
+
+    @property
+    def fb_relations_map(self):
+        """used for freebase relations feature"""
+        return self.resources.get("freebase_relations")
+
+    @property
+    def title_to_id_map(self):
+        """map titles to wid"""
+        return self.resources.get("titles").title2id
+
+    def load_resources(self):
+        """Loads the outlinks, Freebase and title resources now instead of
+        on first use, e.g. before forking workers which should share them."""
+        self.outlinks_map
+        self.fb_relations_map
+        self.title_to_id_map
+
     def init_unary_feature_matrix(self, document):
         """Initializes unary feature matrix for a Document.
         The matrix is m x max_cands_per_mention x num_unary_features. 
@@ -250,36 +340,34 @@ class CoherenceFeatureExtractor:
         @param: document, doc for which to extract unary features
         @return: an  mxcx4 matrix
         """
-        unary_feature_matrix = np.zeros((document.m,self.max_cands_per_mention,\
-                                         self.num_unary_features))
-        for i, mention in enumerate(document.mentions):
-            for j, candidate in enumerate(mention.candidate_titles):
-                # break if we've already got the max number of cands
-                if j >= self.max_cands_per_mention:
-                    break
-                candidate_score = candidate[1]
-
-                # calculate value of features
-                if math.isclose(candidate_score,0.0,rel_tol=1e-9):
-                    f_1 = 0.0
-                    f_2 = 0.0
-                    f_3 = 1.0
-                    f_4 = 0.0
-                elif math.isclose(candidate_score, 1,rel_tol=1e-9):
-                    f_1 = 0.0
-                    f_2 = 0.0
-                    f_3 = 0.0
-                    f_4 = 1.0
-                else:
-                    f_1 = np.log(candidate_score)
-                    f_2 = np.log(1 - candidate_score)
-                    f_3 = 0.0
-                    f_4 = 0.0
-
-                # store feature vector for jth candidate of ith mention
-                unary_feature_matrix[i,j,:] = np.asarray([f_1,f_2,f_3,f_4])
-
-        return unary_feature_matrix
+        return self.init_unary_feature_matrices([document])[0]
+
+    def init_unary_feature_matrices(self, documents):
+        """Unary feature matrices of a batch of documents, see
+        init_unary_feature_matrix. The candidate scores of all documents are
+        gathered into one padded array and the features are computed for
+        all of them at once.
+
+        @param: documents, list of docs for which to extract unary features
+        @return: list with an m x c x 4 matrix for each document
+        """
+        if not documents:
+            return []
+        c = self.max_cands_per_mention
+        num_mentions = [document.m for document in documents]
+        scores = np.zeros((sum(num_mentions), c))
+        mask = np.zeros((sum(num_mentions), c), dtype=bool)
+        row = 0
+        for document in documents:
+            for mention in document.mentions:
+                candidate_scores = [candidate[1] for candidate in mention.candidate_titles[:c]]
+                scores[row,:len(candidate_scores)] = candidate_scores
+                mask[row,:len(candidate_scores)] = True
+                row += 1
+
+        unary_feature_matrix = np.zeros((len(scores), c, self.num_unary_features))
+        unary_feature_matrix[:,:,:4] = unary_features(scores, mask)
+        return np.split(unary_feature_matrix, np.cumsum(num_mentions)[:-1])
 
 
     def init_pairwise_feature_matrix(self, document):
@@ -293,43 +381,85 @@ class CoherenceFeatureExtractor:
         2. Number of Freebase relations between the two titles
         3. Binary feature which is high if the titles are the same
 
+        The second index of mention j is j for j < i and j-1 for j > i. The
+        features are symmetric, so they are computed once for each unordered
+        pair of distinct candidate titles in the document and then scattered
+        into the matrix.
+
         @param: document, document to represented
         @return: feature matrix
         """
-        pairwise_feature_matrix = np.zeros((document.m,document.m-1,self.max_cands_per_mention,
-                                            self.max_cands_per_mention,self.num_pairwise_features))
-        for i, m1 in enumerate(document.mentions):
-            for j, m2 in enumerate(document.mentions):
-                if i != j:
-                    for k, cand_m1 in enumerate(document.mentions[i].candidate_titles):
-                        for l, cand_m2 in enumerate(document.mentions[j].candidate_titles):
-                            # if k or l are greater than the max number of cands, break
-                            if k >= self.max_cands_per_mention or l >= self.max_cands_per_mention:
-                                break
-                            # adjust second index since the second dimension is 
-                            # one smaller than first
-                            if j > i:
-                                j-=1
-                            pairwise_feature_matrix[i,j,k,l,:] = \
-                                self._pairwise_feature_vec(cand_m1[0], cand_m2[0])
+        c = self.max_cands_per_mention
+        m = document.m
+        if m < 2:
+            return np.zeros((m,max(m-1,0),c,c,self.num_pairwise_features))
+
+        # index of each candidate among the unique titles of the document, -1 for padding
+        titles = {}
+        positions = np.full((m,c), -1, dtype=np.int64)
+        for i, mention in enumerate(document.mentions):
+            for k, cand in enumerate(mention.candidate_titles[:c]):
+                positions[i,k] = titles.setdefault(cand[0], len(titles))
+        titles = list(titles)
+
+        # candidate pairs of every pair of different mentions, as unordered
+        # pairs of titles since the features are symmetric
+        shape = (m,m,c,c)
+        first = off_diagonal(np.broadcast_to(positions[:,None,:,None], shape))
+        second = off_diagonal(np.broadcast_to(positions[None,:,None,:], shape))
+        valid = (first >= 0) & (second >= 0)
+        keys = np.minimum(first, second) * len(titles) + np.maximum(first, second)
+        pairs, inverse = np.unique(keys[valid], return_inverse=True)
+
+        # features of each unordered pair once, from the cache if possible
+        table = np.zeros((len(pairs),self.num_pairwise_features))
+        missing = []
+        namespace = self.pair_namespace
+        for p, key in enumerate(pairs):
+            a, b = divmod(int(key), len(titles))
+            cached = self.pair_cache.get(namespace, titles[a], titles[b])
+            if cached is None:
+                missing.append((p, titles[a], titles[b]))
+            else:
+                table[p] = cached
+        if missing:
+            # link counts between the titles of all missing pairs in one go
+            link_counts = None
+            if isinstance(self.outlinks_map, OutlinksGraph):
+                link_counts = self.outlinks_map.link_counts(t for _, yi, yj in missing for t in (yi, yj))
+            for p, yi, yj in missing:
+                table[p] = self.pair_cache.put(namespace, yi, yj,
+                                               self._compute_pairwise_feature_vec(yi, yj, link_counts))
+
+        pairwise_feature_matrix = np.zeros(valid.shape + (self.num_pairwise_features,))
+        pairwise_feature_matrix[valid] = table[inverse]
         return pairwise_feature_matrix
     
-    def _pairwise_feature_vec(self, yi, yj):
+    def _pairwise_feature_vec(self, yi, yj, link_counts=None):
         """ Helper which populates a pairwise feature vector between two titles.
         See comment in init_pairwise_feature_matrix for description of features.
+        The vector is read from, or added to, the pair cache.
 
         @param: yi, first title
         @param: yj, second title
+        @param: link_counts, optional outlinks_graph.LinkCounts holding yi and yj
         @return: vector representation of pairwise similarity of two titles
         """
-        # TODO: some caching here, probably
+        return self.pair_cache.get_or_compute(self.pair_namespace, yi, yj,
+                                              lambda: self._compute_pairwise_feature_vec(yi, yj, link_counts))
+
+    def _compute_pairwise_feature_vec(self, yi, yj, link_counts=None):
+        """Computes the vector of _pairwise_feature_vec without the cache."""
         fv = np.zeros(self.num_pairwise_features)
         if "unk_wid" in yi or "unk_wid" in yj:
             return fv
         # outlinks feature
-        num_outlinks = \
-            count_outlinks(yi,yj,self.outlinks_map) + \
-            count_outlinks(yj,yi,self.outlinks_map)
+        if link_counts is not None:
+            num_outlinks = link_counts.count(yi, yj)
+        else:
+            num_outlinks = \
+                count_outlinks(yi,yj,self.outlinks_map) + \
+                count_outlinks(yj,yi,self.outlinks_map)
         print("num_outlinks: ", num_outlinks)
         if num_outlinks >= 5:
             fv[4] = 1
@@ -1,12 +1,12 @@
 import os
-from urllib import parse
-from data_utils import get_wikititle
-from io_utils import LORELEIKBLoader, get_ta_dir
+from utils.io_utils import LORELEIKBLoader, get_ta_dir
 import sys
 import logging
 logging.basicConfig(format=':%(levelname)s: %(message)s', level=logging.INFO)
 
 logging.info("logging works")
+# run from the root of the repo with
+# python -m utils.evaluation indir [coherence]
 args = {}
 args["indir"] = sys.argv[1]
 evaluate_coherence = False
@@ -14,7 +14,11 @@ if len(sys.argv) > 2:
     if sys.argv[2] == "coherence":
         evaluate_coherence = True
 
+# gold titles come from the title index below, which makes no kb record
+# lookups, so the kb needs no record cache (and has no cache stats to log)
 kb = LORELEIKBLoader(kbfile="data/kb/data/entities.tab")
+# gold entity id to English Wikipedia title
+wikititles = kb.wikititle_index()
 tas = get_ta_dir(args["indir"])
 
 # total recall
@@ -52,14 +56,11 @@ for docs_seen, docta in enumerate(tas):
             continue
         else:
             gold_eid = gold_eid.split("|")[0]
-            wikititle = get_wikititle(kb.kb, gold_eid)
+            goldtitle = wikititles.title(gold_eid)
 
-            if wikititle is None:
+            if goldtitle is None:
                 continue
 
-            goldtitle = wikititle[0].rsplit('/', 1)[-1]
-            goldtitle = parse.unquote(goldtitle)
-
             if goldtitle in cand2score:
                 total_hits+=1
                 if evaluate_coherence and coh_con["label"]==goldtitle:
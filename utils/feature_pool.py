@@ -0,0 +1,108 @@
+import os
+import time
+import logging
+import multiprocessing
+
+"""
+    Feature extraction for many documents over a pool of processes.
+
+    The resources the features are computed from are large, so they are
+    loaded once in the parent and the workers are forked from it. The
+    workers inherit the loaded resources, the documents and the feature
+    extractor copy-on-write (the memory-mapped ones share their pages
+    anyway), so a task is just the index of a document and only the
+    feature arrays are sent back.
+
+    Results come back in document order so they can be streamed to a
+    single writer. The throughput of every worker is logged at the end.
+"""
+
+# set in the parent before forking, inherited by the workers
+_extractor = None
+_documents = None
+
+def _extract_document(index):
+    """
+        @param: index, index of the document in _documents
+        @return: tuple of (index, pid of the worker, seconds spent, unary
+                 features, pairwise features, gold vector)
+    """
+    start = time.time()
+    unary, pairwise, gold = extract_document(_extractor, _documents[index])
+    return index, os.getpid(), time.time() - start, unary, pairwise, gold
+
+def extract_document(extractor, doc):
+    """
+        @param: extractor, a CoherenceFeatureExtractor
+        @param: doc, a Document
+        @return: tuple of (unary features, pairwise features, gold vector)
+    """
+    return (extractor.init_unary_feature_matrix(doc),
+            extractor.init_pairwise_feature_matrix(doc),
+            extractor.init_gold_vector(doc))
+
+class _WorkerStats:
+    """Counts the documents and mentions done by each worker."""
+
+    def __init__(self, num_documents, every=1000):
+        self.num_documents = num_documents
+        self.every = every
+        self.documents = 0
+        self.workers = {}
+        self.start = time.time()
+
+    def update(self, pid, seconds, num_mentions):
+        docs, mentions, busy = self.workers.get(pid, (0, 0, 0.0))
+        self.workers[pid] = (docs + 1, mentions + num_mentions, busy + seconds)
+        self.documents += 1
+        if self.documents % self.every == 0 or self.documents == self.num_documents:
+            elapsed = max(time.time() - self.start, 1e-9)
+            logging.info("%d/%d documents, %.1f docs/sec"
+                         % (self.documents, self.num_documents, self.documents / elapsed))
+
+    def log(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        for pid, (docs, mentions, busy) in sorted(self.workers.items()):
+            logging.info("worker %d: %d documents, %d mentions, %.1f docs/sec busy, %.0f%% busy"
+                         % (pid, docs, mentions, docs / max(busy, 1e-9), 100.0 * busy / elapsed))
+        logging.info("%d documents with %d workers in %.2fs, %.1f docs/sec"
+                     % (self.documents, len(self.workers), elapsed, self.documents / elapsed))
+
+def extract_features(documents, extractor, num_workers=1, chunksize=16):
+    """
+        Extracts the features of every document, in the order of documents.
+
+        @param: documents, list of Documents
+        @param: extractor, a CoherenceFeatureExtractor
+        @param: num_workers, number of processes to extract with
+        @param: chunksize, number of documents handed to a worker at once
+        @return: generator of (unary features, pairwise features, gold vector)
+    """
+    global _extractor, _documents
+    stats = _WorkerStats(len(documents))
+
+    if num_workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        logging.info("fork is not available, extracting features in one process")
+        num_workers = 1
+
+    if num_workers <= 1:
+        for doc in documents:
+            start = time.time()
+            features = extract_document(extractor, doc)
+            stats.update(os.getpid(), time.time() - start, doc.m)
+            yield features
+        stats.log()
+        return
+
+    # load everything before forking so the workers share one copy
+    extractor.load_resources()
+    _extractor, _documents = extractor, documents
+    try:
+        with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+            for index, pid, seconds, unary, pairwise, gold in \
+                    pool.imap(_extract_document, range(len(documents)), chunksize):
+                stats.update(pid, seconds, documents[index].m)
+                yield unary, pairwise, gold
+    finally:
+        _extractor, _documents = None, None
+    stats.log()
@@ -0,0 +1,197 @@
+import os
+import json
+import logging
+
+import numpy as np
+import scipy.sparse as sp
+
+from .freebase_relations import _to_wids, packable, pack_pairs, write_freebase_relation_index, FreebaseRelationIndex
+from .mid_wid_map import load_mid_wid_map, format_mid
+
+"""
+    Typed and multi-hop relatedness between Wikipedia pages from the
+    Freebase relations of FB15K-237.
+
+    The relations are kept as (page, relation type, page) triples. All
+    pairs which are needed are between candidates of some corpus, so the
+    relatedness is precomputed for a vocabulary of candidate pages only:
+
+        typed       number of relations of each type between two pages
+        two hop     number of paths of length two between two pages, through
+                    any page of the graph, computed as S_V S_V^T where S is
+                    the undirected adjacency matrix of all relations and S_V
+                    its rows for the vocabulary
+
+    Pairs are in canonical order and packed as in freebase_relations, so
+    queries are binary searches over sorted arrays.
+
+    Layout of an index directory:
+        meta.json                 relation type names
+        typed_keys.npy            sorted uint64 packed pairs, one entry per type
+        typed_types.npy           int32 relation type of each entry
+        typed_counts.npy          int32 number of relations of that type
+        two_hop/                  freebase_relations index of path counts
+"""
+
+def read_freebase_triples(mid2wid_file, relation_data_dir, mid_wid_dir="resources/mid_wid/"):
+    """
+        Reads the relations of the FB15K-237 dataset with their types,
+        mapped to Wikipedia page ids. Relations between mids without a page
+        are skipped.
+
+        @param: mid2wid_file, a tsv which maps MIDs to Wikipedia page ids
+        @param: relation_data_dir, directory containing the FB15K-237 dataset
+        @param: mid_wid_dir, where the mid_wid_map store is kept
+        @return: generator of (wid, relation, wid)
+    """
+    mid_wid = load_mid_wid_map(mid2wid_file, mid_wid_dir)
+
+    skipped = 0
+    for name in ["train.txt", "valid.txt", "test.txt"]:
+        path = os.path.join(relation_data_dir, name)
+        logging.info(path)
+        with open(path, "r") as relations:
+            triples = [relation.strip().split("\t") for relation in relations]
+        # one batched lookup for all mids of the file
+        wids = mid_wid.mids_to_wids([format_mid(mid) for m1, _, m2 in triples for mid in (m1, m2)])
+        for (m1, rel, m2), w1, w2 in zip(triples, wids[0::2], wids[1::2]):
+            if w1 is None or w2 is None:
+                skipped += 1
+                continue
+            yield w1, rel, w2
+    logging.info("skipped %d relations with a mid not in %s" % (skipped, mid2wid_file))
+
+def build_freebase_paths(triples, vocab, outdir):
+    """
+        Builds the typed and two hop relatedness of the pages in vocab.
+
+        @param: triples, iterable of (wid, relation, wid)
+        @param: vocab, iterable of page ids, e.g. all candidates of a corpus
+        @param: outdir, directory to write the index to
+        @return: tuple of (number of typed pairs, number of two hop pairs)
+    """
+    w1, rels, w2 = [], [], []
+    for a, rel, b in triples:
+        w1.append(a)
+        rels.append(rel)
+        w2.append(b)
+    w1, w2 = _to_wids(w1), _to_wids(w2)
+    relations, types = np.unique(np.asarray(rels, dtype=object), return_inverse=True)
+    valid = packable(w1, w2)
+    w1, w2, types = w1[valid], w2[valid], types[valid]
+
+    vocab = np.unique(_to_wids(list(vocab)))
+    vocab = vocab[(vocab >= 0) & (vocab < 2**32)]
+
+    # direct relations by type, only between pages of the vocabulary
+    in_vocab = np.isin(w1, vocab) & np.isin(w2, vocab)
+    keys = pack_pairs(w1[in_vocab], w2[in_vocab])
+    entries = np.rec.fromarrays([keys, types[in_vocab].astype(np.int32)], names="key,type")
+    entries, typed_counts = np.unique(entries, return_counts=True)
+
+    # undirected adjacency over all pages, so paths may go through any page
+    nodes, node_ids = np.unique(np.concatenate([w1, w2]), return_inverse=True)
+    src, dest = node_ids[:len(w1)], node_ids[len(w1):]
+    n = len(nodes)
+    adjacency = sp.coo_matrix((np.ones(len(src), dtype=np.int64), (src, dest)), shape=(n, n)).tocsr()
+    adjacency = adjacency + adjacency.T
+    adjacency.setdiag(0)
+    adjacency.eliminate_zeros()
+
+    vocab_nodes = np.flatnonzero(np.isin(nodes, vocab))
+    rows = adjacency[vocab_nodes]
+    paths = (rows @ rows.T).tocoo()
+    upper = paths.row < paths.col
+    path_keys = pack_pairs(nodes[vocab_nodes[paths.row[upper]]], nodes[vocab_nodes[paths.col[upper]]])
+    order = np.argsort(path_keys)
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    np.save(os.path.join(outdir, "typed_keys.npy"), entries["key"].astype(np.uint64))
+    np.save(os.path.join(outdir, "typed_types.npy"), entries["type"].astype(np.int32))
+    np.save(os.path.join(outdir, "typed_counts.npy"), typed_counts.astype(np.int32))
+    write_freebase_relation_index(path_keys[order], paths.data[upper][order], os.path.join(outdir, "two_hop"))
+    with open(os.path.join(outdir, "meta.json"), "w") as f:
+        json.dump({"relations": [str(r) for r in relations], "num_vocab": int(len(vocab)),
+                   "num_typed": int(len(entries)), "num_two_hop": int(len(path_keys))}, f)
+    logging.info("wrote relatedness of %d pages, %d typed and %d two hop pairs to %s"
+                 % (len(vocab), len(entries), len(path_keys), outdir))
+    return len(entries), len(path_keys)
+
+class FreebasePaths:
+    """Read only view of an index written by build_freebase_paths."""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.relations = self.meta["relations"]
+        self.keys = np.load(os.path.join(directory, "typed_keys.npy"), mmap_mode='r')
+        self.types = np.load(os.path.join(directory, "typed_types.npy"), mmap_mode='r')
+        self.counts = np.load(os.path.join(directory, "typed_counts.npy"), mmap_mode='r')
+        self.two_hop = FreebaseRelationIndex(os.path.join(directory, "two_hop"))
+
+    @property
+    def num_features(self):
+        return 2 + len(self.relations)
+
+    def typed_counts(self, w1, w2):
+        """
+            @param: w1, sequence of page ids as ints or strings
+            @param: w2, sequence of page ids, the same length as w1
+            @return: len(w1) x number of relation types array of counts
+        """
+        w1, w2 = _to_wids(w1), _to_wids(w2)
+        out = np.zeros((len(w1), len(self.relations)), dtype=np.int64)
+        valid = np.flatnonzero(packable(w1, w2))
+        queries = pack_pairs(w1[valid], w2[valid])
+        lo = np.searchsorted(self.keys, queries, side='left')
+        hi = np.searchsorted(self.keys, queries, side='right')
+        lengths = hi - lo
+        if lengths.sum() == 0:
+            return out
+        # positions of all entries of all queries, and the query of each
+        starts = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+        entries = starts + np.arange(lengths.sum())
+        out[np.repeat(valid, lengths), self.types[entries]] = self.counts[entries]
+        return out
+
+    def features(self, w1, w2):
+        """
+            Relatedness features of pairs of pages: the number of direct
+            relations, the number of two hop paths and the number of direct
+            relations of each type, see relations for their names.
+
+            @param: w1, sequence of page ids as ints or strings
+            @param: w2, sequence of page ids, the same length as w1
+            @return: len(w1) x num_features array
+        """
+        typed = self.typed_counts(w1, w2)
+        return np.column_stack([typed.sum(axis=1), self.two_hop.counts(w1, w2), typed])
+
+    def tensor(self, candidates, max_cands):
+        """
+            Relatedness features between the candidates of every pair of
+            mentions, laid out like outlinks_graph.LinkCounts.tensor.
+
+            @param: candidates, list with the list of candidate page ids of each mention
+            @param: max_cands, number of candidates per mention to keep
+            @return: m x m x max_cands x max_cands x num_features array, padding is 0
+        """
+        m = len(candidates)
+        wids = np.full((m, max_cands), -1, dtype=np.int64)
+        for i, cands in enumerate(candidates):
+            cands = _to_wids(cands[:max_cands])
+            wids[i, :len(cands)] = cands
+        shape = (m, m, max_cands, max_cands)
+        w1 = np.broadcast_to(wids[:, None, :, None], shape).ravel()
+        w2 = np.broadcast_to(wids[None, :, None, :], shape).ravel()
+        return self.features(w1, w2).reshape(shape + (self.num_features,))
+
+if __name__=="__main__":
+    import sys
+    logging.basicConfig(format=':%(levelname)s: %(message)s', level=logging.INFO)
+    # python -m utils.freebase_paths mid2wid_file relation_data_dir vocab_file outdir
+    # where vocab_file has one candidate page id per line
+    with open(sys.argv[3], "r") as f:
+        vocab = [line.strip() for line in f if line.strip()]
+    build_freebase_paths(read_freebase_triples(sys.argv[1], sys.argv[2]), vocab, sys.argv[4])
@@ -0,0 +1,196 @@
+import os
+import json
+import pickle
+import logging
+
+import numpy as np
+
+"""
+    Compact index of the number of Freebase relations between pairs of
+    Wikipedia pages.
+
+    A pair of page ids is put in canonical (min, max) order and packed into
+    one 64 bit integer, min in the high and max in the low 32 bits, so the
+    relations between two pages are found with a single binary search in
+    whichever order they are given. The keys are stored sorted next to
+    their counts and loaded memory mapped.
+
+    Layout of an index directory:
+        meta.json
+        keys.npy      sorted uint64 packed pairs
+        counts.npy    int32 number of relations of each pair
+"""
+
+def _to_wids(wids):
+    """Page ids as an int64 array, -1 for ids which aren't integers."""
+    if isinstance(wids, np.ndarray) and wids.dtype.kind in "iu":
+        return wids.astype(np.int64)
+    out = np.empty(len(wids), dtype=np.int64)
+    for i, wid in enumerate(wids):
+        try:
+            out[i] = int(wid)
+        except (TypeError, ValueError):
+            out[i] = -1
+    return out
+
+def packable(w1, w2):
+    """
+        Page ids are packed into 32 bits each, so pairs with a missing or a
+        negative id or one of 2**32 or more can't be stored or looked up;
+        they would collide with other pairs.
+
+        @param: w1, int64 array of page ids, see _to_wids
+        @param: w2, int64 array of page ids
+        @return: boolean array, True for the pairs which can be packed
+    """
+    return (w1 >= 0) & (w2 >= 0) & (w1 < 2**32) & (w2 < 2**32)
+
+def pack_pairs(w1, w2):
+    """
+        Packs pairs of page ids in canonical order, see packable.
+
+        @param: w1, int64 array of page ids
+        @param: w2, int64 array of page ids
+        @return: uint64 array of packed (min, max) pairs
+    """
+    lo = np.minimum(w1, w2).astype(np.uint64)
+    hi = np.maximum(w1, w2).astype(np.uint64)
+    return (lo << np.uint64(32)) | hi
+
+def build_freebase_relation_index(pairs, outdir):
+    """
+        Builds the index from pairs of related pages. Each occurrence of a
+        pair, in either order, counts as one relation.
+
+        @param: pairs, iterable of (wid, wid)
+        @param: outdir, directory to write the index to
+        @return: the number of distinct pairs
+    """
+    w1, w2 = [], []
+    for a, b in pairs:
+        w1.append(a)
+        w2.append(b)
+    w1, w2 = _to_wids(w1), _to_wids(w2)
+    valid = packable(w1, w2)
+    if not valid.all():
+        logging.info("skipping %d pairs without valid page ids" % np.count_nonzero(~valid))
+    keys, counts = np.unique(pack_pairs(w1[valid], w2[valid]), return_counts=True)
+    write_freebase_relation_index(keys, counts, outdir)
+    return len(keys)
+
+def write_freebase_relation_index(keys, counts, outdir):
+    """
+        @param: keys, sorted uint64 array of packed pairs
+        @param: counts, number of relations of each pair
+        @param: outdir, directory to write the index to
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    np.save(os.path.join(outdir, "keys.npy"), np.asarray(keys, dtype=np.uint64))
+    np.save(os.path.join(outdir, "counts.npy"), np.asarray(counts, dtype=np.int32))
+    with open(os.path.join(outdir, "meta.json"), "w") as f:
+        json.dump({"num_pairs": int(len(keys)), "num_relations": int(np.sum(counts))}, f)
+    logging.info("wrote %d related page pairs to %s" % (len(keys), outdir))
+
+def convert_freebase_relations_dict(freebase_rel_map, outdir):
+    """
+        Converts a dict pickled by preprocess.build_freebase_relations_dict
+        to an index.
+
+        @param: freebase_rel_map, dict of (wid, wid) to number of relations
+        @param: outdir, directory to write the index to
+        @return: the number of distinct pairs
+    """
+    pairs = list(freebase_rel_map)
+    w1 = _to_wids([p[0] for p in pairs])
+    w2 = _to_wids([p[1] for p in pairs])
+    counts = np.fromiter((freebase_rel_map[p] for p in pairs), dtype=np.int64, count=len(pairs))
+    valid = packable(w1, w2)
+    if not valid.all():
+        logging.info("skipping %d pairs without valid page ids" % np.count_nonzero(~valid))
+    keys = pack_pairs(w1[valid], w2[valid])
+    # a pair may be in the dict in both orders
+    keys, inverse = np.unique(keys, return_inverse=True)
+    write_freebase_relation_index(keys, np.bincount(inverse, weights=counts[valid]).astype(np.int64), outdir)
+    return len(keys)
+
+def load_freebase_relation_index(directory, pkl=None):
+    """
+        Opens the index in directory. If it hasn't been built yet it is
+        converted from the pickled dict next to it first, e.g. from
+        resources/freebase_relations.pkl for resources/freebase_relations/.
+
+        @param: directory, directory of the index
+        @param: pkl, dict pickled by preprocess.build_freebase_relations_dict,
+                directory with .pkl in place of the trailing / by default
+        @return: a FreebaseRelationIndex
+    """
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+        if pkl is None:
+            pkl = directory.rstrip("/") + ".pkl"
+        logging.info("freebase relation index not found, converting %s to %s" % (pkl, directory))
+        with open(pkl, "rb") as f:
+            convert_freebase_relations_dict(pickle.load(f), directory)
+    return FreebaseRelationIndex(directory)
+
+class FreebaseRelationIndex:
+    """Read only view of an index written by build_freebase_relation_index."""
+
+    def __init__(self, directory):
+        self.keys = np.load(os.path.join(directory, "keys.npy"), mmap_mode='r')
+        self.counts_ = np.load(os.path.join(directory, "counts.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def counts(self, w1, w2):
+        """
+            Batched count.
+
+            @param: w1, sequence of page ids as ints or strings
+            @param: w2, sequence of page ids, the same length as w1
+            @return: int64 array with the number of relations of each pair
+        """
+        w1, w2 = _to_wids(w1), _to_wids(w2)
+        out = np.zeros(len(w1), dtype=np.int64)
+        valid = packable(w1, w2)
+        if len(self.keys) == 0 or not valid.any():
+            return out
+        queries = pack_pairs(w1[valid], w2[valid])
+        pos = np.minimum(np.searchsorted(self.keys, queries), len(self.keys) - 1)
+        found = self.keys[pos] == queries
+        out[valid] = np.where(found, self.counts_[pos], 0)
+        return out
+
+    def count(self, w1, w2):
+        """
+            @param: w1, page id as int or string
+            @param: w2, page id as int or string
+            @return: the number of Freebase relations between the two pages
+        """
+        return int(self.counts([w1], [w2])[0])
+
+    def tensor(self, candidates, max_cands):
+        """
+            Relation counts between the candidates of every pair of mentions,
+            laid out like outlinks_graph.LinkCounts.tensor.
+
+            @param: candidates, list with the list of candidate page ids of each mention
+            @param: max_cands, number of candidates per mention to keep
+            @return: m x m x max_cands x max_cands array, padding is 0
+        """
+        m = len(candidates)
+        wids = np.full((m, max_cands), -1, dtype=np.int64)
+        for i, cands in enumerate(candidates):
+            cands = _to_wids(cands[:max_cands])
+            wids[i, :len(cands)] = cands
+        w1 = np.broadcast_to(wids[:, None, :, None], (m, m, max_cands, max_cands))
+        w2 = np.broadcast_to(wids[None, :, None, :], (m, m, max_cands, max_cands))
+        return self.counts(w1.ravel(), w2.ravel()).reshape(w1.shape)
+
+if __name__=="__main__":
+    import sys
+    logging.basicConfig(format=':%(levelname)s: %(message)s', level=logging.INFO)
+    # python -m utils.freebase_relations freebase_relations.pkl outdir
+    with open(sys.argv[1], "rb") as f:
+        convert_freebase_relations_dict(pickle.load(f), sys.argv[2])
@@ -0,0 +1,293 @@
+import os
+import json
+import logging
+
+import numpy as np
+
+"""
+    Grid index over the latitude/longitude of KB entities.
+
+    Points are bucketed into cells of cell_deg x cell_deg degrees and
+    stored sorted by cell, with cells numbered row by row. All cells of
+    one row of a bounding box are therefore a single contiguous slice of
+    the points, so a radius query costs a couple of binary searches per
+    row of cells plus an exact haversine check of the points found.
+
+    Layout of an index directory:
+        meta.json      cell size
+        cells.npy      sorted int64 cell number of each point
+        lat.npy, lon.npy, eids.npy
+"""
+
+EARTH_RADIUS_KM = 6371.0
+# kilometers per degree of latitude
+KM_PER_DEG = 2 * np.pi * EARTH_RADIUS_KM / 360.0
+# largest queries x candidates distance array of a batched query
+GEO_BATCH_PAIRS = 1 << 22
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+        Great circle distance in kilometers, works elementwise on arrays.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2)**2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def build_geo_index(records, outdir, cell_deg=0.5):
+    """
+        Builds the grid index from kb records. If an entity id occurs more
+        than once the record is chosen with io_utils.kb_record_date, as it
+        is in the kb stores, so every entity is one point. Records without an
+        integer entity id are skipped, and entities whose record has no valid
+        latitude and longitude are left out.
+
+        @param: records, iterable of kb records (see io_utils.read_kb_records)
+        @param: outdir, directory to write the index to
+        @param: cell_deg, size of a grid cell in degrees
+        @return: the number of points in the index
+    """
+    # imported here since io_utils itself imports from this module
+    from .io_utils import kb_record_date
+    points = {}
+    dates = {}
+    for endict in records:
+        try:
+            eid = int(endict['entityid'])
+        except ValueError:
+            continue
+        date = kb_record_date(endict)
+        if eid in dates and date < dates[eid]:
+            continue
+        dates[eid] = date
+        try:
+            lat = float(endict['latitude'])
+            lon = float(endict['longitude'])
+        except (KeyError, ValueError):
+            points.pop(eid, None)
+            continue
+        if -90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0:
+            points[eid] = (lat, lon)
+        else:
+            points.pop(eid, None)
+    eids = np.fromiter(points.keys(), dtype=np.int64, count=len(points))
+    coords = np.asarray(list(points.values()), dtype=np.float64).reshape(-1, 2)
+    lats, lons = coords[:, 0], coords[:, 1]
+
+    grid = _Grid(cell_deg)
+    cells = grid.cell(lats, lons)
+    order = np.argsort(cells, kind='stable')
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    np.save(os.path.join(outdir, "cells.npy"), cells[order])
+    np.save(os.path.join(outdir, "lat.npy"), lats[order])
+    np.save(os.path.join(outdir, "lon.npy"), lons[order])
+    np.save(os.path.join(outdir, "eids.npy"), eids[order])
+    with open(os.path.join(outdir, "meta.json"), "w") as f:
+        json.dump({"cell_deg": cell_deg, "num_points": int(len(eids))}, f)
+    logging.info("wrote geo index with %d points to %s", len(eids), outdir)
+    return len(eids)
+
+class _Grid:
+    """Numbering of the cells of a cell_deg grid over the globe."""
+
+    def __init__(self, cell_deg):
+        self.cell_deg = cell_deg
+        self.nrows = int(np.ceil(180.0 / cell_deg)) + 1
+        self.ncols = int(np.ceil(360.0 / cell_deg)) + 1
+
+    def row(self, lat):
+        return np.clip(np.floor((np.asarray(lat) + 90.0) / self.cell_deg).astype(np.int64), 0, self.nrows - 1)
+
+    def col(self, lon):
+        return np.clip(np.floor((np.asarray(lon) + 180.0) / self.cell_deg).astype(np.int64), 0, self.ncols - 1)
+
+    def cell(self, lat, lon):
+        return self.row(lat) * self.ncols + self.col(lon)
+
+class GeoIndex:
+    """Read only view of an index written by build_geo_index."""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.grid = _Grid(self.meta["cell_deg"])
+        self.cells = np.load(os.path.join(directory, "cells.npy"), mmap_mode='r')
+        self.lat = np.load(os.path.join(directory, "lat.npy"), mmap_mode='r')
+        self.lon = np.load(os.path.join(directory, "lon.npy"), mmap_mode='r')
+        self.eids = np.load(os.path.join(directory, "eids.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.eids)
+
+    def _candidate_ranges(self, lat0, lat1, lon0, lon1, radius_km):
+        """
+            Slices of the points in the cells overlapping the bounding box of
+            everything within radius_km of each rectangle [lat0, lat1] x
+            [lon0, lon1]. Every box contributes one slice per row of cells
+            and per side of the antimeridian it covers.
+
+            @param: lat0, lat1, lon0, lon1, arrays with the corners of the boxes
+            @param: radius_km, distance to widen the boxes by
+            @return: tuple of arrays (box of each slice, starts, ends)
+        """
+        dlat = radius_km / KM_PER_DEG
+        lat0, lat1 = np.maximum(lat0 - dlat, -90.0), np.minimum(lat1 + dlat, 90.0)
+        # the box gets wider in longitude towards the poles
+        max_abs_lat = np.maximum(np.abs(lat0), np.abs(lat1))
+        cos_lat = np.cos(np.radians(np.minimum(max_abs_lat, 89.0)))
+        dlon = radius_km / (KM_PER_DEG * cos_lat)
+        full = (max_abs_lat >= 89.0) | (lon1 - lon0 + 2 * dlon >= 360.0)
+        lon0, lon1 = lon0 - dlon, lon1 + dlon
+        # split boxes which cross the antimeridian
+        west, east = ~full & (lon0 < -180.0), ~full & (lon1 > 180.0)
+        lo = np.where(full, -180.0, np.where(west, lon0 + 360.0, lon0))
+        hi = np.where(full | west | east, 180.0, lon1)
+        split = np.flatnonzero(west | east)
+        boxes = np.concatenate([np.arange(len(lo)), split])
+        lo = np.concatenate([lo, np.full(len(split), -180.0)])
+        hi = np.concatenate([hi, np.where(west[split], lon1[split], lon1[split] - 360.0)])
+
+        row0, row1 = self.grid.row(lat0[boxes]), self.grid.row(lat1[boxes])
+        nrows = row1 - row0 + 1
+        ranges = np.repeat(np.arange(len(boxes)), nrows)
+        rows = row0[ranges] + _positions(nrows)
+        first = rows * self.grid.ncols
+        starts = np.searchsorted(self.cells, first + self.grid.col(lo)[ranges])
+        ends = np.searchsorted(self.cells, first + self.grid.col(hi)[ranges] + 1)
+        return boxes[ranges], starts, ends
+
+    def _radius_batch(self, lats, lons, radius_km):
+        """
+            Radius query for many points. Queries are grouped by the cell
+            they fall in and the candidates of a group are read once, from
+            the box around all of its queries. The distances of every query
+            to the candidates of its group are then computed and ranked as
+            flat arrays, at most GEO_BATCH_PAIRS at a time.
+
+            @param: lats, array of latitudes of the query points
+            @param: lons, array of longitudes of the query points
+            @param: radius_km, maximum distance in kilometers
+            @return: list of (entity ids, distances in km), nearest first, in
+                     the order of the queries
+        """
+        if len(lats) == 0:
+            return []
+        _, group = np.unique(self.grid.cell(lats, lons), return_inverse=True)
+        ngroups = group.max() + 1
+        lat0 = np.full(ngroups, np.inf)
+        lat1 = np.full(ngroups, -np.inf)
+        lon0, lon1 = lat0.copy(), lat1.copy()
+        np.minimum.at(lat0, group, lats)
+        np.maximum.at(lat1, group, lats)
+        np.minimum.at(lon0, group, lons)
+        np.maximum.at(lon1, group, lons)
+
+        # points of each group, contiguous and in group order
+        boxes, starts, ends = self._candidate_ranges(lat0, lat1, lon0, lon1, radius_km)
+        order = np.argsort(boxes, kind='stable')
+        boxes, starts, ends = boxes[order], starts[order], ends[order]
+        lengths = ends - starts
+        points = np.repeat(starts, lengths) + _positions(lengths)
+        group_sizes = np.bincount(boxes, weights=lengths, minlength=ngroups).astype(np.int64)
+        group_starts = np.concatenate([[0], np.cumsum(group_sizes)[:-1]])
+
+        # one (query, point) pair per candidate of the query's group
+        npairs = group_sizes[group]
+        bounds = np.concatenate([[0], np.cumsum(npairs)])
+        results = []
+        q0 = 0
+        while q0 < len(lats):
+            q1 = max(q0 + 1, int(np.searchsorted(bounds, bounds[q0] + GEO_BATCH_PAIRS, side='right')) - 1)
+            queries = np.repeat(np.arange(q0, q1), npairs[q0:q1])
+            idx = points[np.repeat(group_starts[group[q0:q1]], npairs[q0:q1]) + _positions(npairs[q0:q1])]
+            dist = haversine_km(lats[queries], lons[queries], self.lat[idx], self.lon[idx])
+            keep = dist <= radius_km
+            queries, idx, dist = queries[keep], idx[keep], dist[keep]
+            ranked = np.lexsort((dist, queries))
+            eids, dist = np.asarray(self.eids[idx[ranked]]), dist[ranked]
+            splits = np.cumsum(np.bincount(queries - q0, minlength=q1 - q0))[:-1]
+            results.extend(zip(np.split(eids, splits), np.split(dist, splits)))
+            q0 = q1
+        return results
+
+    def radius(self, lat, lon, radius_km):
+        """
+            Finds the entities within a distance of a point.
+
+            @param: lat, latitude of the query point
+            @param: lon, longitude of the query point
+            @param: radius_km, maximum distance in kilometers
+            @return: tuple of (entity ids, distances in km), nearest first
+        """
+        return self._radius_batch(np.asarray([lat], dtype=np.float64),
+                                  np.asarray([lon], dtype=np.float64), radius_km)[0]
+
+    def nearest(self, lat, lon, n):
+        """
+            Finds the n entities closest to a point. The search radius starts
+            at one cell and doubles until n entities are within it.
+
+            @param: lat, latitude of the query point
+            @param: lon, longitude of the query point
+            @param: n, number of entities to return
+            @return: tuple of (entity ids, distances in km), nearest first
+        """
+        return self.nearest_many([(lat, lon)], n)[0]
+
+    def radius_many(self, coords, radius_km):
+        """
+            Batched radius, see _radius_batch.
+
+            @param: coords, iterable of (lat, lon)
+            @param: radius_km, maximum distance in kilometers
+            @return: list of (entity ids, distances in km)
+        """
+        lats, lons = _coord_arrays(coords)
+        return self._radius_batch(lats, lons, radius_km)
+
+    def nearest_many(self, coords, n):
+        """
+            Batched nearest. All queries start at a radius of one cell, and
+            the queries with fewer than n entities within it are searched
+            again together at twice the radius.
+
+            @param: coords, iterable of (lat, lon)
+            @param: n, number of entities to return per query
+            @return: list of (entity ids, distances in km)
+        """
+        lats, lons = _coord_arrays(coords)
+        n = min(n, len(self))
+        results = [None] * len(lats)
+        pending = np.arange(len(lats))
+        radius_km = self.grid.cell_deg * KM_PER_DEG
+        while len(pending):
+            found = self._radius_batch(lats[pending], lons[pending], radius_km)
+            done = radius_km >= np.pi * EARTH_RADIUS_KM
+            remaining = []
+            for q, (eids, dist) in zip(pending, found):
+                if len(eids) >= n or done:
+                    results[q] = (eids[:n], dist[:n])
+                else:
+                    remaining.append(q)
+            pending = np.asarray(remaining, dtype=np.int64)
+            radius_km *= 2
+        return results
+
+def _coord_arrays(coords):
+    """
+        @param: coords, iterable of (lat, lon)
+        @return: tuple of float64 arrays of latitudes and longitudes
+    """
+    coords = np.asarray(list(coords), dtype=np.float64).reshape(-1, 2)
+    return coords[:, 0].copy(), coords[:, 1].copy()
+
+def _positions(lengths):
+    """
+        @param: lengths, int array
+        @return: concatenation of arange(l) for every l in lengths
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.arange(offsets.size, dtype=np.int64) - offsets
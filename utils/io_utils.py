@@ -4,18 +4,41 @@ import pickle
 import argparse
 import sys
 import os
+import time
+import sqlite3
+import itertools
+import operator
+import io
+import collections
+import multiprocessing
+import shutil
 from os import listdir
 from os.path import isfile, join
-from sqlitedict import SqliteDict
+from sqlitedict import SqliteDict, encode, decode
 import tensorflow as tf
 import numpy as np
 
 from ccg_nlpy import core, local_pipeline, remote_pipeline
 
+from .name_index import NameIndex, NameIndexBuilder
+from .kb_cache import CachedKB
+from .kb_wikititles import WikiTitleIndex, build_wikititle_index
+from .geo_index import GeoIndex, build_geo_index
+from .mid_wid_map import load_mid_wid_map
+from .title_dictionary import TitleDictionary, build_title_dictionary
+from .outlinks_graph import build_outlinks_graph, save_outlinks_graph, load_outlinks_graph
+from .sparse_features import to_coo, pair_features
+from .feature_pool import extract_features
+from .pair_cache import titles_key
+
 # Location of file which maps mids to Wikipedia page ids
 MID2WID="/shared/preprocessed/upadhya3/enwiki-datamachine/mid.wikipedia_en_id"
-MID2WID_PKL="resources/mid2wid.pkl"
-WID2MID_PKL="resources/wid2mid.pkl"
+# store of mid_wid_map.MidWidMap, replaces the mid2wid and wid2mid pickles
+MID_WID_DIR="resources/mid_wid/"
+# pickled pair of Wikipedia id to title and title to id dicts
+ID2TITLE_PKL="/shared/preprocessed/upadhya3/enwiki-datamachine/idmap/enwiki-20170520.id2t.pkl"
+# store of title_dictionary.TitleDictionary, built from ID2TITLE_PKL
+TITLE_DICT_DIR="resources/titles/"
 
 def save_pkl(fname, obj):
     """
@@ -85,39 +108,121 @@ def serialize_tas(tas, directory):
             print("Writing %s to file."%filename)
             json.dump(ta.as_json, f, indent=4, ensure_ascii=False)
         
-def outlinks(outlinks_file):
+def iter_outlinks(outlinks_file, titles=None):
     """
-        Creates a map of titles to hyperlinks on that title's page. This used
-        to calculate the number of times two pages link to each other.
+        Streams the pages of the outlinks file as (title, list of outlinks)
+        without reading the whole file into memory. A page is held back for
+        one line of lookahead, since the next line may continue its list of
+        outlinks. Pages without outlinks are skipped.
 
         @param: outlinks_file tsv where column 1 is a Wikipedia title and column 2
                               is a space separated string of outlinks from that page
-        @return: outlinks_map a map from string to list of strings
+        @param: titles, optional collection of titles, e.g. the candidate titles
+                of a data set. Only pages with one of these titles, and only
+                their links to one of these titles, are returned.
+        @return: generator of (title, list of outlink titles)
     """
-    outlinks_map = {}
+    def keep(title, links):
+        if titles is None:
+            return links
+        return [link for link in links if link in titles]
+
     with open(outlinks_file, "r") as f:
-        # used to fix lines which have titles with a "\n" character
-        prev_title = None
-        for line in f.readlines():
+        # the last page with outlinks, continuation lines are added to it
+        title, links = None, None
+        for line in f:
             spline = line.split("\t")
 
             # there is at least one case where a hyperlink contains "\n"
             # which creates an erroneous line. 
             if len(spline) == 1:
-                outlinks_map[prev_title].extend(spline[0].strip().split(" "))
+                if links is None:
+                    logging.warning("skipping continuation line before the first page of %s", outlinks_file)
+                    continue
+                links.extend(spline[0].strip().split(" "))
                 continue
             # this is handling the case where there is "\t" in one of the titles
             # this causes the list of titles to be split into two fields
             elif len(spline) > 2:
-                title = spline[0]
-                outlinks = " ".join(spline[1:]).strip()
+                next_title = spline[0]
+                next_links = " ".join(spline[1:]).strip()
             else:
-                title = spline[0]
-                outlinks = spline[1].strip()
-            if outlinks:
-                outlinks_map[title] = outlinks.strip().split(" ")
-                prev_title = title
-    return outlinks_map
+                next_title = spline[0]
+                next_links = spline[1].strip()
+            if next_links:
+                if links is not None and (titles is None or title in titles):
+                    yield title, keep(title, links)
+                title, links = next_title, next_links.split(" ")
+        if links is not None and (titles is None or title in titles):
+            yield title, keep(title, links)
+
+def outlinks(outlinks_file, titles=None):
+    """
+        Creates a map of titles to hyperlinks on that title's page. This used
+        to calculate the number of times two pages link to each other.
+
+        @param: outlinks_file tsv where column 1 is a Wikipedia title and column 2
+                              is a space separated string of outlinks from that page
+        @param: titles, optional collection of titles to restrict the map to,
+                see iter_outlinks
+        @return: outlinks_map a map from string to list of strings
+    """
+    return dict(iter_outlinks(outlinks_file, titles))
+
+def outlinks_graph(outlinks_file, titles=None):
+    """
+        Same as outlinks but the result is an outlinks_graph.OutlinksGraph,
+        which stores the links as integer ids and answers link counts with a
+        binary search. The pages are streamed into the graph, so no map of
+        strings is built on the way.
+
+        If the binary graph written by build_outlinks_graph_file exists next
+        to outlinks_file and is newer than it, the graph is memory mapped
+        from there instead of being parsed. The mapped graph is complete,
+        titles only restricts a graph which is parsed.
+
+        @param: outlinks_file tsv where column 1 is a Wikipedia title and column 2
+                              is a space separated string of outlinks from that page
+        @param: titles, optional collection of titles to restrict the graph to,
+                see iter_outlinks
+        @return: an OutlinksGraph, with a cache_key made of the file it was
+                 read from and the titles it was restricted to
+    """
+    graph_file = outlinks_graph_path(outlinks_file)
+    if os.path.exists(graph_file) and os.path.getmtime(graph_file) >= os.path.getmtime(outlinks_file):
+        logging.info("loading outlinks graph from %s", graph_file)
+        graph = load_outlinks_graph(graph_file)
+        titles = None
+    else:
+        graph = build_outlinks_graph(iter_outlinks(outlinks_file, titles))
+    # see pair_cache.resource_key
+    graph.cache_key = ("outlinks", os.path.abspath(outlinks_file), os.path.getmtime(outlinks_file),
+                       titles_key(titles))
+    return graph
+
+def outlinks_graph_path(outlinks_file):
+    """Path of the binary outlinks graph of outlinks_file."""
+    return outlinks_file + ".graph"
+
+def build_outlinks_graph_file(outlinks_file, graph_file=None):
+    """
+        Parses outlinks_file, with the same repairs of titles containing
+        "\t" or "\n" as outlinks, and writes the binary graph which
+        outlinks_graph loads.
+
+        @param: outlinks_file tsv where column 1 is a Wikipedia title and column 2
+                              is a space separated string of outlinks from that page
+        @param: graph_file, where to write the graph, next to outlinks_file by default
+        @return: the path of the graph file
+    """
+    if graph_file is None:
+        graph_file = outlinks_graph_path(outlinks_file)
+    graph = build_outlinks_graph(iter_outlinks(outlinks_file))
+    # write to a temporary file so readers never map a partial graph
+    tmp_file = graph_file + ".tmp"
+    save_outlinks_graph(graph, tmp_file)
+    os.replace(tmp_file, graph_file)
+    return graph_file
     
 # Names of fields in LORELEI kb
 fields = ['origin', 'entity_type', 'entityid', 'name', 'asciiname', 'latitude', 'longitude', 'feature_class',
@@ -130,6 +235,30 @@ fields = ['origin', 'entity_type', 'entityid', 'name', 'asciiname', 'latitude',
        'org_members_employees_per', 'org_parent_org', 'executive_board_members', 'jurisdiction',
        'trusteeship_council', 'national_societies', 'external_link']
 
+# Entity id boundaries of the sources which make up the LORELEI kb. Ids below
+# APB_MIN come from GeoNames, the rest from the APB, WLL and augmented sources.
+APB_MIN = 20000001
+WLL_MIN = 30000001
+AUG_MIN = 71000001
+# kb sources in id order
+KB_SOURCES = ["GEO", "APB", "WLL", "AUG"]
+
+def kb_source(eid):
+    """
+        Returns the source of a kb entity based on its id.
+
+        @param: eid, entity id as int or string
+        @return: one of KB_SOURCES
+    """
+    eid = int(eid)
+    if eid < APB_MIN:
+        return "GEO"
+    elif eid < WLL_MIN:
+        return "APB"
+    elif eid < AUG_MIN:
+        return "WLL"
+    return "AUG"
+
 def save(fname, obj):
     """
         Serializes object to given filename.
@@ -150,6 +279,377 @@ def load(fname):
     with open(fname, 'rb') as f:
         return pickle.load(f)
 
+# Number of rows written to SQLite per executemany call during a bulk build
+KB_BATCH_SIZE = 100000
+# Size in bytes of the pieces of entities.tab parsed by each worker
+KB_CHUNK_SIZE = 64 * 1024 * 1024
+
+def parse_kb_line(line):
+    """
+        Parses one line of the LORELEI kb into a record. Empty fields
+        are left out of the record.
+
+        @param: line, a tab separated line from entities.tab
+        @return: dict of field name to value or None if the line is malformed
+    """
+    parts = line.rstrip('\n').split('\t')
+    if len(parts) != len(fields):
+        return None
+    endict = {}
+    for field, v in zip(fields, parts):
+        if len(v) != 0:
+            endict[field] = v
+    return endict
+
+def read_kb_records(kbfile):
+    """
+        Generator over the records of the LORELEI kb. Malformed lines are
+        logged and skipped.
+
+        @param: kbfile, the path to source kb
+        @return: generator of kb records, see parse_kb_line
+    """
+    with open(kbfile) as f:
+        for idx, line in enumerate(f):
+            if idx > 0 and idx % 1000000 == 0:
+                logging.info("read %d lines", idx)
+            endict = parse_kb_line(line)
+            if endict is None:
+                logging.info("bad line %d", idx)
+                continue
+            yield endict
+
+def kb_chunks(kbfile, chunk_size=KB_CHUNK_SIZE):
+    """
+        Splits the kb file into byte ranges of roughly chunk_size bytes
+        which start and end on line boundaries.
+
+        @param: kbfile, the path to source kb
+        @param: chunk_size, target size of a chunk in bytes
+        @return: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(kbfile)
+    chunks = []
+    with open(kbfile, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            # move to the beginning of the next line
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def _parse_kb_chunk(kbfile, start, end):
+    """
+        Worker for read_kb_records_parallel. Parses the lines in a byte
+        range of the kb file.
+
+        @return: tuple of (records, number of lines, chunk-relative indices
+                 of bad lines)
+    """
+    with open(kbfile, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    records = []
+    bad_lines = []
+    idx = -1
+    # decode and split lines the same way iterating over open(kbfile) does
+    for idx, line in enumerate(io.TextIOWrapper(io.BytesIO(data))):
+        endict = parse_kb_line(line)
+        if endict is None:
+            bad_lines.append(idx)
+            continue
+        records.append(endict)
+    return records, idx + 1, bad_lines
+
+def read_kb_records_parallel(kbfile, num_workers, chunk_size=KB_CHUNK_SIZE):
+    """
+        Same as read_kb_records but the kb is split into chunks which are
+        parsed in a pool of worker processes. Chunks are consumed in file order,
+        so records and bad line numbers come out exactly as they do from
+        read_kb_records. At most two chunks per worker are in flight at once
+        to bound memory.
+
+        @param: kbfile, the path to source kb
+        @param: num_workers, number of worker processes
+        @param: chunk_size, target size of a chunk in bytes
+        @return: generator of kb records, see parse_kb_line
+    """
+    chunks = iter(kb_chunks(kbfile, chunk_size))
+    lines_read = 0
+    with multiprocessing.Pool(num_workers) as pool:
+        pending = collections.deque()
+        for start, end in itertools.islice(chunks, 2 * num_workers):
+            pending.append(pool.apply_async(_parse_kb_chunk, (kbfile, start, end)))
+        while pending:
+            records, num_lines, bad_lines = pending.popleft().get()
+            for start, end in itertools.islice(chunks, 1):
+                pending.append(pool.apply_async(_parse_kb_chunk, (kbfile, start, end)))
+            for idx in bad_lines:
+                logging.info("bad line %d", lines_read + idx)
+            if (lines_read + num_lines) // 1000000 > lines_read // 1000000:
+                logging.info("read %d lines", lines_read + num_lines)
+            lines_read += num_lines
+            for endict in records:
+                yield endict
+
+def kb_record_date(endict):
+    """
+        When one entity id occurs more than once in the kb, the record with
+        the latest modification_date is kept, the later line on a tie. Every
+        way of building the stores resolves duplicates with this rule.
+
+        @param: endict, a kb record
+        @return: the modification date of the record, '' if it has none
+    """
+    return endict.get('modification_date', '')
+
+def _stage_kb_records(e2e, n2e, records, batch_size):
+    """
+        Stages records in temporary tables: kb_staging in e2e holds one
+        record per entity id, chosen with kb_record_date, and staging in n2e
+        holds every record under its name, in source order.
+
+        @return: tuple of (number of records read, whether reading was
+                 interrupted)
+    """
+    e2e.execute('CREATE TEMP TABLE kb_staging (key TEXT PRIMARY KEY, date TEXT, value BLOB)')
+    n2e.execute('CREATE TEMP TABLE staging (seq INTEGER PRIMARY KEY, name TEXT, value BLOB)')
+    stage_kb = ('INSERT INTO kb_staging (key, date, value) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET date = excluded.date, value = excluded.value '
+                'WHERE excluded.date >= kb_staging.date')
+    stage_name = 'INSERT INTO staging (name, value) VALUES (?, ?)'
+
+    count = 0
+    interrupted = False
+    kb_rows = []
+    staged_rows = []
+    try:
+        for endict in records:
+            value = encode(endict)
+            kb_rows.append((endict['entityid'], kb_record_date(endict), value))
+            staged_rows.append((endict['name'], value))
+            count += 1
+            if len(kb_rows) >= batch_size:
+                e2e.executemany(stage_kb, kb_rows)
+                n2e.executemany(stage_name, staged_rows)
+                kb_rows = []
+                staged_rows = []
+    except KeyboardInterrupt:
+        logging.info("ending prematurely.")
+        interrupted = True
+    e2e.executemany(stage_kb, kb_rows)
+    n2e.executemany(stage_name, staged_rows)
+    return count, interrupted
+
+def _write_name_lists(n2e, batch_size, only_changed=False):
+    """
+        Writes the list of records of every staged name to name2ent. Records
+        sharing a name keep their order in the source file.
+
+        @param: only_changed, if True a list is only written if it differs
+                from the one stored for its name
+        @return: the number of names written
+    """
+    insert_n2e = 'REPLACE INTO "name2ent" (key, value) VALUES (?, ?)'
+    staged = n2e.execute('SELECT name, value FROM staging ORDER BY name, seq')
+    written = 0
+    n2e_rows = []
+    for name, group in itertools.groupby(staged, key=operator.itemgetter(0)):
+        records = [decode(value) for _, value in group]
+        if only_changed:
+            stored = n2e.execute('SELECT value FROM "name2ent" WHERE key = ?', (name,)).fetchone()
+            if stored is not None and decode(stored[0]) == records:
+                continue
+        n2e_rows.append((name, encode(records)))
+        written += 1
+        if len(n2e_rows) >= batch_size:
+            n2e.executemany(insert_n2e, n2e_rows)
+            n2e_rows = []
+    n2e.executemany(insert_n2e, n2e_rows)
+    return written
+
+def bulk_load_kb(records, e2e_path, n2e_path, batch_size=KB_BATCH_SIZE):
+    """
+        Writes kb records to the SQLite stores read by LORELEIKBLoader in a
+        single transaction per store. Records are first staged in temporary
+        tables, by entity id so duplicate ids are resolved with
+        kb_record_date, and by name so every entry of name2ent is pickled
+        and written exactly once, instead of being re-read and re-written
+        per record.
+
+        The tables are created through SqliteDict and the values are encoded
+        with its encoder, so the result can be opened with SqliteDict as usual.
+
+        If reading the records is interrupted, what was read so far is
+        written and the KeyboardInterrupt is raised again, so the caller
+        doesn't take the partial store for a complete one.
+
+        @param: records, iterable of kb records (see read_kb_records)
+        @param: e2e_path, path of the entity id to record store
+        @param: n2e_path, path of the name to records store
+        @param: batch_size, number of rows per batched insert
+        @return: the number of distinct entity ids written
+    """
+    start = time.time()
+    # let SqliteDict create the tables so the schema matches the read path
+    SqliteDict(e2e_path, tablename='lorelei').close()
+    SqliteDict(n2e_path, tablename='name2ent').close()
+    e2e = sqlite3.connect(e2e_path)
+    n2e = sqlite3.connect(n2e_path)
+
+    count, interrupted = _stage_kb_records(e2e, n2e, records, batch_size)
+    logging.info("Writing KB dictionary to disk.")
+    e2e.execute('REPLACE INTO "lorelei" (key, value) SELECT key, value FROM kb_staging')
+    num_ids = e2e.execute('SELECT COUNT(*) FROM kb_staging').fetchone()[0]
+    e2e.execute('DROP TABLE kb_staging')
+    e2e.commit()
+    e2e.close()
+
+    _write_name_lists(n2e, batch_size)
+    n2e.execute('DROP TABLE staging')
+    n2e.commit()
+    n2e.close()
+
+    elapsed = time.time() - start
+    logging.info("bulk loaded %d records (%d distinct ids) in %.1fs (%.0f rows/sec)",
+                 count, num_ids, elapsed, count / max(elapsed, 1e-9))
+    if interrupted:
+        raise KeyboardInterrupt
+    return num_ids
+
+def kb_manifest_path(kbfile):
+    """Path of the version manifest of the stores built from kbfile."""
+    return kbfile + "manifest.json"
+
+def read_kb_manifest(kbfile):
+    """
+        @param: kbfile, the path to source kb
+        @return: the manifest written by write_kb_manifest or None
+    """
+    path = kb_manifest_path(kbfile)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def write_kb_manifest(kbfile, **stats):
+    """
+        Records which version of the source kb the stores were built from.
+        The size and modification time of the source are stored, so whether
+        the stores are current can be checked without reading the source.
+
+        @param: kbfile, the path to source kb
+        @param: stats, extra counts to record, e.g. from apply_kb_delta
+        @return: the manifest
+    """
+    previous = read_kb_manifest(kbfile)
+    st = os.stat(kbfile)
+    manifest = {
+        "version": previous["version"] + 1 if previous else 1,
+        "source_size": st.st_size,
+        "source_mtime": st.st_mtime,
+        "written": time.time(),
+    }
+    manifest.update(stats)
+    with open(kb_manifest_path(kbfile), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+def kb_store_is_current(kbfile):
+    """
+        @param: kbfile, the path to source kb
+        @return: True if the manifest matches the current source file
+    """
+    manifest = read_kb_manifest(kbfile)
+    if manifest is None:
+        return False
+    st = os.stat(kbfile)
+    return manifest["source_size"] == st.st_size and manifest["source_mtime"] == st.st_mtime
+
+# Fraction of the entity ids which may change before apply_kb_delta
+# rewrites the stores entirely instead of row by row
+KB_DELTA_REBUILD_FRACTION = 0.25
+
+def apply_kb_delta(kbfile, e2e_path, n2e_path, read_records=read_kb_records, names=None,
+                   batch_size=KB_BATCH_SIZE, rebuild_fraction=KB_DELTA_REBUILD_FRACTION):
+    """
+        Brings existing SQLite stores up to date with a new version of the
+        source kb by writing only what changed, instead of rebuilding them.
+
+        The source is staged like in bulk_load_kb, so duplicate ids are
+        resolved the same way (see kb_record_date), and then compared with
+        the stores in SQL. Records not in the store are inserted, records
+        which differ from the stored one are updated and stored ids missing
+        from the source are deleted. name2ent holds every line of the source,
+        including duplicate lines which lose to another line of their id, so
+        it is compared by name instead: only the lists which differ from the
+        stored ones are rewritten. If more than rebuild_fraction of the ids
+        changed, both tables are replaced from the staged source instead,
+        since that is cheaper than updating most of their rows.
+
+        @param: kbfile, the path to the new source kb
+        @param: e2e_path, path of the entity id to record store
+        @param: n2e_path, path of the name to records store
+        @param: read_records, function which returns the records of kbfile
+        @param: names, optional NameIndexBuilder fed the records of kbfile
+        @param: batch_size, number of rows per batched insert
+        @param: rebuild_fraction, see above
+        @return: dict with the number of inserted, updated and deleted records
+                 and of the names rewritten or removed in name2ent
+    """
+    start = time.time()
+    e2e = sqlite3.connect(e2e_path)
+    n2e = sqlite3.connect(n2e_path)
+    records = read_records(kbfile)
+    if names is not None:
+        records = names.collect(records)
+    count, interrupted = _stage_kb_records(e2e, n2e, records, batch_size)
+    if interrupted:
+        e2e.close()
+        n2e.close()
+        raise KeyboardInterrupt
+
+    # the encoded values may differ for equal records, so they are compared decoded
+    inserted = [key for key, in e2e.execute('SELECT s.key FROM kb_staging s LEFT JOIN lorelei l '
+                                            'ON l.key = s.key WHERE l.key IS NULL')]
+    updated = []
+    for key, new, old in e2e.execute('SELECT s.key, s.value, l.value FROM kb_staging s JOIN lorelei l '
+                                     'ON l.key = s.key WHERE s.value != l.value'):
+        if decode(new) != decode(old):
+            updated.append(key)
+    deleted = [key for key, in e2e.execute('SELECT key FROM lorelei WHERE key NOT IN '
+                                           '(SELECT key FROM kb_staging)')]
+    counts = {"inserted": len(inserted), "updated": len(updated), "deleted": len(deleted)}
+
+    num_ids = e2e.execute('SELECT COUNT(*) FROM kb_staging').fetchone()[0]
+    logging.info("Writing KB dictionary to disk.")
+    if len(inserted) + len(updated) + len(deleted) > rebuild_fraction * max(num_ids, 1):
+        logging.info("most of the kb changed, rewriting the stores")
+        e2e.execute('DELETE FROM "lorelei"')
+        e2e.execute('INSERT INTO "lorelei" (key, value) SELECT key, value FROM kb_staging')
+        n2e.execute('DELETE FROM "name2ent"')
+        counts["names"] = _write_name_lists(n2e, batch_size)
+    else:
+        e2e.execute('CREATE TEMP TABLE changed_keys (key TEXT PRIMARY KEY)')
+        e2e.executemany('INSERT INTO changed_keys (key) VALUES (?)', ((k,) for k in inserted + updated))
+        e2e.execute('REPLACE INTO "lorelei" (key, value) SELECT key, value FROM kb_staging '
+                    'WHERE key IN (SELECT key FROM changed_keys)')
+        e2e.executemany('DELETE FROM "lorelei" WHERE key = ?', ((k,) for k in deleted))
+        # names no line of the source has any more
+        removed = n2e.execute('DELETE FROM "name2ent" WHERE key NOT IN (SELECT name FROM staging)').rowcount
+        counts["names"] = removed + _write_name_lists(n2e, batch_size, only_changed=True)
+    e2e.commit()
+    e2e.close()
+    n2e.commit()
+    n2e.close()
+    logging.info("kb delta: %d inserted, %d updated, %d deleted, %d names rewritten",
+                 counts["inserted"], counts["updated"], counts["deleted"], counts["names"])
+    logging.info("applied kb delta in %.1fs", time.time() - start)
+    return counts
+
 class LORELEIKBLoader:
     """
         Class for loading the LORELEI knowledge base (KB).
@@ -158,14 +658,52 @@ class LORELEIKBLoader:
         using the unique KB id or using the surface of a mention which
         may map to multiple records in the kb.
     """
-    def __init__(self, kbfile):
+    def __init__(self, kbfile, bulk=True, backend="sqlite", num_workers=1, update=False,
+                 cache_size=None, cache_fields=None, sources=None):
+        # if True the kb is built with bulk_load_kb, otherwise it is built
+        # one SqliteDict assignment at a time
+        self.bulk = bulk
+        # number of processes used to parse the kb file when building stores
+        self.num_workers = num_workers
+        # if True, existing stores which are older than the kb file are
+        # brought up to date with apply_kb_delta
+        self.update = update
+        # storage used for self.kb: "sqlite", "columns" in which case self.kb
+        # is a kb_columns.ColumnarKB or "shards" for a kb_columns.ShardedKB
+        self.backend = backend
+        # sources (see KB_SOURCES) opened by the "shards" backend, all if None
+        self.sources = sources
         # map of entity id to kb record
         self.kb = {}
         # map of surface form of mention to list of kb records to which
         # it may refer.
         self.name2ent = {}
-        self._load_kb(kbfile)
+        # normalized name and asciiname to entity ids, see name_index.NameIndex
+        self.name_index = None
+        self.kbfile = kbfile
+        # entity id to English Wikipedia titles, see wikititle_index
+        self._wikititles = None
+        # spatial index over latitude/longitude, see geo_index
+        self._geo = None
+        if backend == "sqlite":
+            self._load_kb(kbfile)
+        elif backend == "columns":
+            self._load_kb_columns(kbfile)
+        elif backend == "shards":
+            self._load_kb_shards(kbfile)
+        else:
+            raise ValueError("unknown kb backend %s" % backend)
+        if cache_size:
+            # LRU caches in front of both stores, see kb_cache.CachedKB
+            self.kb = CachedKB(self.kb, cache_size, cache_fields)
+            self.name2ent = CachedKB(self.name2ent, cache_size, cache_fields)
     
+    def _read_records(self, kbfile):
+        """Returns a generator over the records of the kb file, see read_kb_records."""
+        if self.num_workers > 1:
+            return read_kb_records_parallel(kbfile, self.num_workers)
+        return read_kb_records(kbfile)
+
     def _load_kb(self, kbfile):
         """
             Helper function which builds the primary resources of the class.
@@ -179,31 +717,57 @@ class LORELEIKBLoader:
         """
         e2e_path = kbfile + "e2e.pkl"
         n2e_path = kbfile + "n2e.pkl"
+        names_dir = kbfile + "names/"
+        if os.path.exists(e2e_path) and not kb_store_is_current(kbfile):
+            if self.update:
+                logging.info("kb store is out of date, applying changes from %s", kbfile)
+                names = NameIndexBuilder()
+                counts = apply_kb_delta(kbfile, e2e_path, n2e_path, self._read_records, names)
+                names.write(names_dir)
+                # derived stores are immutable, they are rebuilt when next used
+                for derived in ("columns/", "shards/", "wikititles/", "geo/"):
+                    if os.path.exists(kbfile + derived):
+                        shutil.rmtree(kbfile + derived)
+                write_kb_manifest(kbfile, **counts)
+            else:
+                logging.info("kb store may be out of date with %s", kbfile)
+        records = self._read_records(kbfile)
+        names = None
+        # False if building the store was interrupted
+        complete = True
+        if not os.path.exists(names_dir + "meta.json"):
+            logging.info("name index not found, building %s", names_dir)
+            names = NameIndexBuilder()
+            # the index is built during the pass which builds the kb
+            records = names.collect(records)
         if os.path.exists(e2e_path):
             logging.info("pkl found! loading map %s", e2e_path)
             self.kb = SqliteDict(e2e_path, tablename='lorelei', flag='r')
             self.name2ent = SqliteDict(n2e_path, tablename='name2ent', flag='r')
+            if names is not None:
+                # the kb is already built so the index needs its own pass
+                for endict in records:
+                    pass
+        elif self.bulk:
+            logging.info("pkl not found ...")
+            try:
+                num_records = bulk_load_kb(records, e2e_path, n2e_path)
+                write_kb_manifest(kbfile, num_records=num_records)
+            except KeyboardInterrupt:
+                # the store is partial, so no manifest or name index is
+                # written and it is treated as out of date from now on
+                complete = False
+            self.kb = SqliteDict(e2e_path, tablename='lorelei', flag='r')
+            self.name2ent = SqliteDict(n2e_path, tablename='name2ent', flag='r')
         else:
             logging.info("pkl not found ...")
             self.kb = SqliteDict(e2e_path, tablename='lorelei', autocommit=False)
             self.name2ent = SqliteDict(n2e_path, tablename='name2ent', autocommit=False)
             try:
-                for idx, line in enumerate(open(kbfile)):
-                    if idx > 0 and idx % 1000000 == 0:
-                        logging.info("read %d lines", idx)
-
-                    parts = line.rstrip('\n').split('\t')
-
-                    if len(parts) != len(fields):
-                        logging.info("bad line %d", idx)
-                        continue
-                        
-                    endict = {}
-                    
-                    for field, v in zip(fields, parts):
-                        if len(v) != 0:
-                            endict[field] = v
-                    self.kb[endict['entityid']] = endict
+                for endict in records:
+                    old = self.kb.get(endict['entityid'])
+                    if old is None or kb_record_date(endict) >= kb_record_date(old):
+                        self.kb[endict['entityid']] = endict
                     name = endict['name']
 
                     if name not in self.name2ent:
@@ -217,71 +781,199 @@ class LORELEIKBLoader:
                 self.kb.close()
                 self.name2ent.commit()
                 self.name2ent.close()
+                write_kb_manifest(kbfile)
 
                 self.kb = SqliteDict(e2e_path, tablename='lorelei', flag='r')
                 self.name2ent = SqliteDict(n2e_path, tablename='name2ent', flag='r')
             except KeyboardInterrupt:
                 logging.info("ending prematurely.")
+                complete = False
                 logging.info("Writing KB dictionary to disk.")
                 self.kb.commit()
                 self.kb.close()
                 self.name2ent.commit()
                 self.name2ent.close()
                 # reopen the kb now
-                self.kb = SqliteDict(e2e_path, tablename='geonames',jflag='r')
+                self.kb = SqliteDict(e2e_path, tablename='lorelei', flag='r')
                 self.name2ent = SqliteDict(n2e_path, tablename='name2ent', flag='r')
 
-        def __getitem__(self, item):
-            return self.kb[item]
+        if names is not None and complete:
+            names.write(names_dir)
+        if os.path.exists(names_dir + "meta.json"):
+            self.name_index = NameIndex(names_dir)
 
-        def keys(self):
-            return self.kb.keys()
+    def _prepare_columnar(self, kbfile, store_dir, build):
+        """
+            Makes sure a columnar store and the name index exist, without
+            touching the SQLite stores. Whatever is missing is built in one
+            pass over the kb, a store of another kb_columns.COLUMNS_FORMAT
+            counts as missing. A store older than the kb file is rebuilt,
+            together with the name index, if self.update is True.
+
+            @param: kbfile, the path to source kb
+            @param: store_dir, directory of the store
+            @param: build, function of (records, store_dir) which builds it
+        """
+        # imported here since kb_columns itself imports from this module
+        from .kb_columns import COLUMNS_FORMAT
+        names_dir = kbfile + "names/"
+        meta = store_dir + "meta.json"
+        if os.path.exists(meta):
+            with open(meta, "r") as f:
+                if json.load(f).get("format") != COLUMNS_FORMAT:
+                    logging.info("%s has an older layout, rebuilding it", store_dir)
+                    shutil.rmtree(store_dir)
+        if os.path.exists(meta) and os.path.getmtime(kbfile) > os.path.getmtime(meta):
+            if self.update:
+                logging.info("%s is out of date, rebuilding it", store_dir)
+                for stale in (store_dir, names_dir):
+                    if os.path.exists(stale):
+                        shutil.rmtree(stale)
+            else:
+                logging.info("%s may be out of date with %s", store_dir, kbfile)
+        names = None
+        records = self._read_records(kbfile)
+        if not os.path.exists(names_dir + "meta.json"):
+            logging.info("name index not found, building %s", names_dir)
+            names = NameIndexBuilder()
+            records = names.collect(records)
+        if not os.path.exists(meta):
+            logging.info("%s not found, building it", store_dir)
+            build(records, store_dir)
+        elif names is not None:
+            for endict in records:
+                pass
+        if names is not None:
+            names.write(names_dir)
+        self.name_index = NameIndex(names_dir)
+
+    def _load_kb_columns(self, kbfile):
+        """
+            Opens the columnar store of the kb and the name index, building
+            them first if they don't exist yet. The SQLite stores aren't
+            opened, name2ent is a kb_columns.KBNames.
+
+            @param: kbfile, the path to source kb which will be loaded
+        """
+        # imported here since kb_columns itself imports from this module
+        from .kb_columns import ColumnarKB, KBNames, build_kb_columns
+        columns_dir = kbfile + "columns/"
+        self._prepare_columnar(kbfile, columns_dir, build_kb_columns)
+        self.kb = ColumnarKB(columns_dir)
+        self.name2ent = KBNames(self.kb)
+
+    def _load_kb_shards(self, kbfile):
+        """
+            Opens the kb sharded by source, only self.sources of it, and the
+            name index, building them first if they don't exist yet. The
+            SQLite stores aren't opened, name2ent is a kb_columns.KBNames
+            which only returns records of the open sources.
+
+            @param: kbfile, the path to source kb which will be loaded
+        """
+        # imported here since kb_columns itself imports from this module
+        from .kb_columns import ShardedKB, KBNames, build_kb_shards
+        shards_dir = kbfile + "shards/"
+        self._prepare_columnar(kbfile, shards_dir, build_kb_shards)
+        self.kb = ShardedKB(shards_dir, self.sources)
+        self.name2ent = KBNames(self.kb)
+
+    def wikititle_index(self):
+        """
+            Returns the index of entity ids to English Wikipedia titles which is
+            stored next to the kb, building it first if it doesn't exist yet.
+
+            @return: a kb_wikititles.WikiTitleIndex
+        """
+        if self._wikititles is None:
+            titles_dir = self.kbfile + "wikititles/"
+            if not os.path.exists(titles_dir + "meta.json"):
+                logging.info("wikipedia title index not found, building %s", titles_dir)
+                build_wikititle_index(self._read_records(self.kbfile), titles_dir)
+            self._wikititles = WikiTitleIndex(titles_dir)
+        return self._wikititles
+
+    def geo_index(self):
+        """
+            Returns the spatial index over the latitude/longitude of the kb
+            entities which is stored next to the kb, building it first if it
+            doesn't exist yet.
+
+            @return: a geo_index.GeoIndex
+        """
+        if self._geo is None:
+            geo_dir = self.kbfile + "geo/"
+            if not os.path.exists(geo_dir + "meta.json"):
+                logging.info("geo index not found, building %s", geo_dir)
+                build_geo_index(self._read_records(self.kbfile), geo_dir)
+            self._geo = GeoIndex(geo_dir)
+        return self._geo
+
+    def cache_stats(self):
+        """
+            @return: dict with the stats of the kb and name2ent caches, empty
+                     if the loader was created without cache_size
+        """
+        stats = {}
+        if isinstance(self.kb, CachedKB):
+            stats["kb"] = self.kb.stats()
+            stats["name2ent"] = self.name2ent.stats()
+        return stats
+
+    def __getitem__(self, item):
+        return self.kb[item]
+
+    def keys(self):
+        return self.kb.keys()
 
 def get_mid_wid_map():
     """
-        Retrieves map of Freebase ids to Wikipedia page ids.
-        First it looks for a pickle in resources/ if that isn't
-        found, it builds the map from MID2WID and pickles it before
-        returning the map.
+        Retrieves map of Freebase ids to Wikipedia page ids. The map is
+        a view of the process wide "mid_wid" resource, which is built from
+        MID2WID the first time it is needed.
 
         @return: map of mids to Wiki ids
     """
-    if os.path.exists(MID2WID_PKL):
-        logging.info("Mid to Wid map found. Loading pickle")
-        return load_pkl(MID2WID_PKL)
-    else: 
-        logging.info("Mid to Wid map not found. Building map.")
-        mid2wid = {}
-        with open(MID2WID, "r") as f:
-            for line in f.readlines():
-                mid,wid = line.strip().split("\t")
-                mid2wid[mid] = wid
-        logging.info("Pickliing map to %s."%MID2WID_PKL)
-        save_pkl(MID2WID_PKL,mid2wid)
-        return mid2wid
+    from .resources import registry
+    return registry.get("mid_wid").mid2wid
 
 def get_wid_mid_map():
     """
-        Retrieves map of Wikipedia page ids to Freebase ids.
-        First it looks for a pickle in resources/ if that isn't
-        found, it builds the map from MID2WID and pickles it before
-        returning the map.
+        Retrieves map of Wikipedia page ids to Freebase ids. The map is
+        a view of the process wide "mid_wid" resource, which is built from
+        MID2WID the first time it is needed.
 
         @return: map of Wiki ids to mids
     """
-    if os.path.exists(WID2MID_PKL):
-        logging.info("Wid to mid map found. Loading pickle")
-        return load_pkl(WID2MID_PKL)
-    else: 
-        logging.info("Wid to mid map not found. Building map.")
-        wid2mid = {}
-        with open(MID2WID, "r") as f:
-            for line in f.readlines():
-                mid,wid = line.strip().split("\t")
-                wid2mid[wid] = mid
-        logging.info("Pickliing map to %s."%WID2MID_PKL)
-        save_pkl(WID2MID_PKL,wid2mid)
-        return wid2mid 
+    from .resources import registry
+    return registry.get("mid_wid").wid2mid
+
+def load_title_dictionary(directory=TITLE_DICT_DIR, id2title_pkl=ID2TITLE_PKL):
+    """
+        Opens the dictionary between Wikipedia page ids and titles, building
+        it from id2title_pkl first if it doesn't exist yet.
+
+        @param: directory, where the dictionary is kept
+        @param: id2title_pkl, pickled pair of id to title and title to id dicts
+        @return: a title_dictionary.TitleDictionary
+    """
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+        logging.info("Title dictionary not found. Building it from %s."%id2title_pkl)
+        m = load_pkl(id2title_pkl)
+        build_title_dictionary(m[0], m[1], directory)
+        del m
+    return TitleDictionary(directory)
+
+def title_dictionary():
+    """
+        Returns the process wide title dictionary of resources.registry,
+        opened on first use.
+
+        @return: a title_dictionary.TitleDictionary
+    """
+    # imported here since resources imports this module
+    from .resources import registry
+    return registry.get("titles")
 
 def id_to_title_map():
     """
@@ -289,18 +981,14 @@ def id_to_title_map():
 
         @return: Wiki page id to title map
     """
-    # TODO: this needs to be fleshed out
-    m = load_pkl("/shared/preprocessed/upadhya3/enwiki-datamachine/idmap/enwiki-20170520.id2t.pkl")
-    return m[0]
+    return title_dictionary().id2title
 
 def title_to_id_map():
     """Returns a map from Wikipedia titles to Wikipedia pageids.         
 
     @return: Wiki page id to title map
     """
-    # TODO: this needs to be fleshed out
-    m = load_pkl("/shared/preprocessed/upadhya3/enwiki-datamachine/idmap/enwiki-20170520.id2t.pkl")
-    return m[1]
+    return title_dictionary().title2id
 
 """ The three following functions are used for creating TFRecords."""
 def _int64_feature(value):
@@ -312,37 +1000,25 @@ def _float64_feature(value):
 def _bytes_feature(value):
   return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
-def write_tfrecord(documents, tfrecord_name, coherence_feature_extractor):
-    """Converts a list of documents into a tfrecord."""
-    single_raw = []
-    single_shapes = []
-    pair_raw = []
-    pair_shapes = []
-    truth = []
-
-    for doc in documents:
-        unary_fm = coherence_feature_extractor.init_unary_feature_matrix(doc)
-        single_shapes.append(unary_fm.shape)
-        single_raw.append(np.ravel(unary_fm))
-        pairwise_fm = coherence_feature_extractor.init_pairwise_feature_matrix(doc)
-        pair_shapes.append(pairwise_fm.shape) 
-        pair_raw.append(np.ravel(pairwise_fm))
-        truth.append(coherence_feature_extractor.init_gold_vector(doc))
-    
-    print(single_raw)
+def write_tfrecord(documents, tfrecord_name, coherence_feature_extractor, sparse=False, num_workers=1):
+    """Converts a list of documents into a tfrecord. With sparse the pairwise
+    features are written as COO, to be read with write_tfrecords.decode_sparse.
+    With more than one worker the features are extracted by a process pool,
+    see feature_pool, and written as they come back, in document order."""
     print('Writing', tfrecord_name)
 
     with tf.python_io.TFRecordWriter(tfrecord_name) as writer:
-        for s_shp, s, p_shp, p, t in zip(single_shapes, single_raw, pair_shapes, pair_raw, truth):
-            example = tf.train.Example(
-                    features=tf.train.Features(
-                        feature={
-                            'single_shp': _int64_feature(list(s_shp)),
-                            'single': _float64_feature(s),
-                            'pair_shp': _int64_feature(list(p_shp)),
-                            'pair':   _float64_feature(p),
-                            'truth':  _int64_feature(t)
-                            })
-                        )
+        for unary_fm, pairwise_fm, gold in extract_features(documents, coherence_feature_extractor, num_workers):
+            feature = {
+                'single_shp': _int64_feature(list(unary_fm.shape)),
+                'single': _float64_feature(np.ravel(unary_fm)),
+                'truth':  _int64_feature(gold)
+                }
+            pair = to_coo(pairwise_fm)[:2] if sparse else np.ravel(pairwise_fm)
+            feature.update(pair_features(pairwise_fm.shape, pair, sparse))
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
             writer.write(example.SerializeToString())
+    if num_workers <= 1:
+        # workers have their own copies of the cache
+        coherence_feature_extractor.pair_cache.log_stats()
 
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+
+from .cache_stats import CacheStatsMixin
+
+"""
+    Bounded read-through LRU cache for the KB stores of LORELEIKBLoader.
+
+    Lookups in the SQLite store unpickle the record on every access, so
+    popular entities seen over and over during evaluation and analysis
+    are decoded again each time. CachedKB sits in front of any store
+    which supports store[key] and keeps the most recently used values,
+    optionally projected onto the fields a job actually reads.
+"""
+
+# stored for keys which aren't in the store, so misses on unknown names
+# don't go back to disk either
+_MISSING = object()
+
+class CachedKB(CacheStatsMixin):
+    """
+        LRU cache in front of a kb store, e.g. LORELEIKBLoader.kb (entity id
+        to record) or LORELEIKBLoader.name2ent (name to list of records).
+    """
+    stats_name = "kb"
+
+    def __init__(self, store, maxsize=100000, fields=None):
+        """
+            @param: store, the store to read through to
+            @param: maxsize, maximum number of keys kept in the cache
+            @param: fields, if given only these fields of each record are
+                    cached and returned, except by get_field which reads
+                    any other field from the store
+        """
+        self.store = store
+        self.maxsize = maxsize
+        self.fields = list(fields) if fields is not None else None
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _project(self, record):
+        """Keeps only the cached fields of a record."""
+        return {f: record[f] for f in self.fields if f in record}
+
+    def _load(self, key):
+        """Reads a value from the underlying store, projected if necessary."""
+        if self.fields is not None and hasattr(self.store, "get_field"):
+            # the columnar store can read the projected fields directly
+            if key not in self.store:
+                return _MISSING
+            record = {}
+            for f in self.fields:
+                v = self.store.get_field(key, f)
+                if v is not None:
+                    record[f] = v
+            return record
+        try:
+            value = self.store[key]
+        except KeyError:
+            return _MISSING
+        if self.fields is None:
+            return value
+        if isinstance(value, list):
+            return [self._project(record) for record in value]
+        return self._project(value)
+
+    def _get(self, key):
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        value = self._load(key)
+        self.cache[key] = value
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._get(key) is not _MISSING
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        return default if value is _MISSING else value
+
+    def get_field(self, key, field, default=None):
+        """
+            Single field lookup for stores of records, see
+            kb_columns.ColumnarKB.get_field. A field outside of the cached
+            fields is read from the underlying store without caching it.
+        """
+        if self.fields is not None and field not in self.fields:
+            if hasattr(self.store, "get_field"):
+                return self.store.get_field(key, field, default)
+            try:
+                return self.store[key].get(field, default)
+            except KeyError:
+                return default
+        value = self._get(key)
+        if value is _MISSING:
+            return default
+        return value.get(field, default)
+
+    def keys(self):
+        return self.store.keys()
+
+    def __len__(self):
+        return len(self.store)
+
+    def clear(self):
+        """Empties the cache, the counters are kept."""
+        self.cache.clear()
@@ -0,0 +1,441 @@
+import os
+import json
+import bisect
+import logging
+import time
+import collections
+
+import numpy as np
+
+from .io_utils import fields, read_kb_records, kb_source, kb_record_date, KB_SOURCES
+from .string_heap import StringHeapWriter, StringHeap, EncodedStrings, write_string_heap
+
+"""
+    Columnar, memory mapped storage for the LORELEI KB.
+
+    Every field in io_utils.fields is stored as its own string heap in
+    input order. Records are found through a sorted array of integer entity
+    ids and a parallel array of row numbers, so reading one field of one
+    entity is a binary search and a slice of the field's heap; nothing is
+    unpickled and fields which aren't asked for are never touched.
+
+    Every row is kept in the heaps, including the rows of duplicate ids
+    which lose to another row of their id. They are reachable through the
+    exact name index only, which like the SQLite name2ent lists every line
+    of the source under its name.
+
+    Layout of a store directory:
+        meta.json          fields, number of records, value counts and format
+        eids.npy           sorted int64 entity ids
+        rows.npy           row in the heaps for each entry of eids.npy
+        lines.npy          line of the source of each row
+        <field>.heap       values of field in input order
+        <field>.offsets.npy
+        exact_names.heap, exact_names.offsets.npy    sorted, unique names
+        exact_name_offsets.npy     start of each name's rows in exact_name_rows
+        exact_name_rows.npy        rows of each name, in input order
+"""
+
+# version of the layout above, stores of another version are rebuilt
+COLUMNS_FORMAT = 2
+
+def _to_eid(eid):
+    """Converts an entity id to int, ids which aren't integers map to -1."""
+    try:
+        return int(eid)
+    except ValueError:
+        return -1
+
+# fields whose value counts are kept in meta.json, so statistics of a store
+# don't need a scan
+STATS_FIELDS = ["entity_type", "country_code", "feature_class"]
+
+class KBColumnsWriter:
+    """Writes a columnar store one record at a time, see build_kb_columns."""
+
+    def __init__(self, outdir):
+        self.outdir = outdir
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        self.writers = [StringHeapWriter(os.path.join(outdir, field)) for field in fields]
+        self.eids = []
+        self.dates = []
+        self.lines = []
+
+    def add(self, endict, line=None):
+        """
+            Appends a record. Records whose entityid isn't an integer (e.g. the
+            header of entities.tab) are skipped.
+
+            @param: endict, a kb record
+            @param: line, position of the record in the source, by default
+                    the number of records added before it
+        """
+        eid = _to_eid(endict['entityid'])
+        if eid < 0:
+            logging.info("skipping non-integer entity id %s", endict['entityid'])
+            return
+        self.lines.append(len(self.lines) if line is None else line)
+        self.eids.append(eid)
+        self.dates.append(kb_record_date(endict))
+        for field, writer in zip(fields, self.writers):
+            writer.append(endict.get(field, ""))
+
+    def close(self):
+        """
+            Writes the id index and metadata of the store.
+
+            @return: the number of entities in the store
+        """
+        for writer in self.writers:
+            writer.close()
+        eids = np.asarray(self.eids, dtype=np.int64)
+        # rows ordered by id, then by io_utils.kb_record_date, then by input order
+        rows = np.lexsort((np.arange(len(eids)), np.asarray(self.dates, dtype=str), eids))
+        eids = eids[rows]
+        # keep the last row of every run of duplicate ids
+        last = np.ones(len(eids), dtype=bool)
+        last[:-1] = eids[1:] != eids[:-1]
+        eids, rows = eids[last], rows[last]
+        np.save(os.path.join(self.outdir, "eids.npy"), eids)
+        np.save(os.path.join(self.outdir, "rows.npy"), rows)
+
+        # statistics are over the rows which are kept, one per entity
+        stats = {}
+        for field in STATS_FIELDS:
+            column = StringHeap(os.path.join(self.outdir, field))
+            stats[field] = dict(collections.Counter(column[int(row)] for row in rows))
+        links = StringHeap(os.path.join(self.outdir, "external_link"))
+        num_wikipedia = sum(1 for row in rows if "en.wikipedia" in links[int(row)])
+        num_entities = int(len(eids))
+        np.save(os.path.join(self.outdir, "lines.npy"), np.asarray(self.lines, dtype=np.int64))
+        self._write_exact_names()
+        with open(os.path.join(self.outdir, "meta.json"), "w") as f:
+            json.dump({"format": COLUMNS_FORMAT, "fields": fields, "num_rows": int(len(self.eids)),
+                       "num_entities": num_entities,
+                       "min_eid": int(eids[0]) if len(eids) else None,
+                       "max_eid": int(eids[-1]) if len(eids) else None,
+                       "num_wikipedia": num_wikipedia,
+                       "stats": stats}, f)
+        return num_entities
+
+    def _write_exact_names(self):
+        """Writes the index of every row, not only the kept ones, by its exact name."""
+        column = StringHeap(os.path.join(self.outdir, "name"))
+        # str ordering is code point ordering, which is also the byte
+        # ordering of the UTF-8 encoded heap that lookups search
+        pairs = sorted((column[row], row) for row in range(len(column)))
+        names = []
+        offsets = []
+        for i, (name, _) in enumerate(pairs):
+            if not names or names[-1] != name:
+                names.append(name)
+                offsets.append(i)
+        offsets.append(len(pairs))
+        write_string_heap(names, os.path.join(self.outdir, "exact_names"))
+        np.save(os.path.join(self.outdir, "exact_name_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+        np.save(os.path.join(self.outdir, "exact_name_rows.npy"),
+                np.asarray([row for _, row in pairs], dtype=np.int64))
+
+def build_kb_columns(records, outdir):
+    """
+        Builds a columnar store from kb records. Records whose entityid isn't
+        an integer (e.g. the header of entities.tab) are skipped. If an entity
+        id occurs more than once the record is chosen with
+        io_utils.kb_record_date, as it is in the SQLite store.
+
+        @param: records, iterable of kb records (see io_utils.read_kb_records)
+        @param: outdir, directory to write the store to
+        @return: the number of entities in the store
+    """
+    start = time.time()
+    writer = KBColumnsWriter(outdir)
+    for endict in records:
+        writer.add(endict)
+    num_entities = writer.close()
+    logging.info("built columnar kb with %d entities in %.1fs", num_entities, time.time() - start)
+    return num_entities
+
+def build_kb_shards(records, outdir):
+    """
+        Builds one columnar store per kb source (see io_utils.KB_SOURCES) in
+        outdir/<source>/, so jobs can open only the sources they need.
+
+        @param: records, iterable of kb records (see io_utils.read_kb_records)
+        @param: outdir, directory to write the shards to
+        @return: dict of source to number of entities
+    """
+    start = time.time()
+    writers = {source: KBColumnsWriter(os.path.join(outdir, source)) for source in KB_SOURCES}
+    for line, endict in enumerate(records):
+        eid = _to_eid(endict['entityid'])
+        if eid < 0:
+            logging.info("skipping non-integer entity id %s", endict['entityid'])
+            continue
+        # the line lets name lookups merge the shards back into source order
+        writers[kb_source(eid)].add(endict, line)
+    counts = {source: writer.close() for source, writer in writers.items()}
+    with open(os.path.join(outdir, "meta.json"), "w") as f:
+        json.dump({"format": COLUMNS_FORMAT, "sources": KB_SOURCES, "num_entities": counts}, f)
+    logging.info("built kb shards %s in %.1fs", counts, time.time() - start)
+    return counts
+
+class ColumnarKB:
+    """
+        Read only view of a store written by build_kb_columns. Supports the
+        same kb[eid] access as the SQLite store as well as single field
+        lookups through get_field, which is what most callers need.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.eids = np.load(os.path.join(directory, "eids.npy"), mmap_mode='r')
+        self.rows = np.load(os.path.join(directory, "rows.npy"), mmap_mode='r')
+        # field heaps are opened the first time they are used
+        self.columns = {}
+        # exact name index, opened the first time a name is looked up
+        self._exact_names = None
+
+    def column(self, field):
+        """
+            @param: field, name of a kb field
+            @return: the StringHeap holding the values of field in row order
+        """
+        if field not in self.columns:
+            self.columns[field] = StringHeap(os.path.join(self.directory, field))
+        return self.columns[field]
+
+    def _row(self, eid):
+        """Returns the heap row of an entity id or None if it isn't in the kb."""
+        eid = _to_eid(eid)
+        pos = np.searchsorted(self.eids, eid)
+        if pos < len(self.eids) and self.eids[pos] == eid:
+            return int(self.rows[pos])
+        return None
+
+    def _rows(self, eids):
+        """Vectorized _row, missing ids get row -1."""
+        eids = np.asarray([_to_eid(eid) for eid in eids], dtype=np.int64)
+        if len(self.eids) == 0:
+            return np.full(len(eids), -1, dtype=np.int64)
+        pos = np.searchsorted(self.eids, eids)
+        pos_c = np.minimum(pos, len(self.eids) - 1)
+        found = (pos < len(self.eids)) & (self.eids[pos_c] == eids)
+        return np.where(found, self.rows[pos_c], -1)
+
+    def get_field(self, eid, field, default=None):
+        """
+            Looks up a single field of a record.
+
+            @param: eid, entity id as int or string
+            @param: field, name of the field
+            @param: default, returned if the entity or the field is missing
+            @return: the value of the field
+        """
+        row = self._row(eid)
+        if row is None:
+            return default
+        value = self.column(field)[row]
+        return value if value else default
+
+    def get_fields(self, eids, field, default=None):
+        """
+            Batched get_field.
+
+            @param: eids, iterable of entity ids
+            @param: field, name of the field
+            @param: default, value used for missing entities or fields
+            @return: list of values in the order of eids
+        """
+        column = self.column(field)
+        values = []
+        for row in self._rows(eids):
+            value = column[row] if row >= 0 else None
+            values.append(value if value else default)
+        return values
+
+    def iter_field(self, field):
+        """
+            Scans a field sequentially in heap order, which is a single
+            forward read of the field's heap.
+
+            @return: generator of (entity id, value) for non-empty values
+        """
+        column = self.column(field)
+        rows = np.asarray(self.rows)
+        eid_of_row = np.full(len(column), -1, dtype=np.int64)
+        eid_of_row[rows] = self.eids
+        for row, eid in enumerate(eid_of_row):
+            if eid < 0:
+                continue
+            value = column[row]
+            if value:
+                yield str(eid), value
+
+    def _record(self, row):
+        """Builds the record stored in a heap row."""
+        endict = {}
+        for field in fields:
+            value = self.column(field)[row]
+            if value:
+                endict[field] = value
+        return endict
+
+    def name_records(self, name):
+        """
+            Looks up every row whose name is exactly name, including rows of
+            duplicate ids which aren't returned by kb[eid].
+
+            @param: name, the name as it is in the kb
+            @return: list of (line in the source, record), in source order
+        """
+        if self._exact_names is None:
+            names = StringHeap(os.path.join(self.directory, "exact_names"))
+            self._exact_names = (EncodedStrings(names),
+                                 np.load(os.path.join(self.directory, "exact_name_offsets.npy"), mmap_mode='r'),
+                                 np.load(os.path.join(self.directory, "exact_name_rows.npy"), mmap_mode='r'),
+                                 np.load(os.path.join(self.directory, "lines.npy"), mmap_mode='r'))
+        encoded, offsets, name_rows, lines = self._exact_names
+        key = name.encode('utf-8')
+        i = bisect.bisect_left(encoded, key)
+        if i == len(encoded) or encoded[i] != key:
+            return []
+        return [(int(lines[row]), self._record(int(row))) for row in name_rows[offsets[i]:offsets[i+1]]]
+
+    def __getitem__(self, eid):
+        row = self._row(eid)
+        if row is None:
+            raise KeyError(eid)
+        return self._record(row)
+
+    def __contains__(self, eid):
+        return self._row(eid) is not None
+
+    def __len__(self):
+        return len(self.eids)
+
+    def get(self, eid, default=None):
+        try:
+            return self[eid]
+        except KeyError:
+            return default
+
+    def keys(self):
+        for eid in self.eids:
+            yield str(eid)
+
+class KBNames:
+    """
+        name2ent for the columnar backends, so they don't need the SQLite
+        store. Like the SQLite name2ent a name maps to the records of every
+        line of the source with exactly that name, in source order, including
+        lines of duplicate ids which lose to another line of their id. A
+        ShardedKB only returns the records of its open sources.
+    """
+
+    def __init__(self, kb):
+        """
+            @param: kb, a ColumnarKB or ShardedKB
+        """
+        self.kb = kb
+
+    def get(self, name, default=None):
+        records = self.kb.name_records(name)
+        if not records:
+            return default
+        return [endict for _, endict in records]
+
+    def __getitem__(self, name):
+        records = self.get(name)
+        if records is None:
+            raise KeyError(name)
+        return records
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+class ShardedKB:
+    """
+        Read only view of the shards written by build_kb_shards. Lookups are
+        routed to the shard of the entity's source; only the shards listed in
+        sources are opened, ids from other sources are reported as missing.
+    """
+
+    def __init__(self, directory, sources=None):
+        """
+            @param: directory, directory the shards were written to
+            @param: sources, list of sources to open, all of them if None
+        """
+        self.sources = list(sources) if sources is not None else list(KB_SOURCES)
+        self.shards = {source: ColumnarKB(os.path.join(directory, source)) for source in self.sources}
+
+    def _shard(self, eid):
+        """Returns the open shard which would hold eid or None."""
+        eid = _to_eid(eid)
+        if eid < 0:
+            return None
+        return self.shards.get(kb_source(eid))
+
+    def stats(self):
+        """
+            Source level statistics read from the shards' metadata.
+
+            @return: dict of source to the meta.json of its shard
+        """
+        return {source: shard.meta for source, shard in self.shards.items()}
+
+    def get_field(self, eid, field, default=None):
+        shard = self._shard(eid)
+        if shard is None:
+            return default
+        return shard.get_field(eid, field, default)
+
+    def get_fields(self, eids, field, default=None):
+        return [self.get_field(eid, field, default) for eid in eids]
+
+    def name_records(self, name):
+        """See ColumnarKB.name_records, the open shards are merged by line."""
+        records = []
+        for source in self.sources:
+            records.extend(self.shards[source].name_records(name))
+        records.sort(key=lambda item: item[0])
+        return records
+
+    def iter_field(self, field):
+        for source in self.sources:
+            for item in self.shards[source].iter_field(field):
+                yield item
+
+    def __getitem__(self, eid):
+        shard = self._shard(eid)
+        if shard is None:
+            raise KeyError(eid)
+        return shard[eid]
+
+    def __contains__(self, eid):
+        shard = self._shard(eid)
+        return shard is not None and eid in shard
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards.values())
+
+    def get(self, eid, default=None):
+        try:
+            return self[eid]
+        except KeyError:
+            return default
+
+    def keys(self):
+        for source in self.sources:
+            for eid in self.shards[source].keys():
+                yield eid
+
+if __name__=="__main__":
+    import sys
+    logging.basicConfig(format=':%(levelname)s: %(message)s', level=logging.INFO)
+    if len(sys.argv) > 3 and sys.argv[3] == "shards":
+        build_kb_shards(read_kb_records(sys.argv[1]), sys.argv[2])
+    else:
+        build_kb_columns(read_kb_records(sys.argv[1]), sys.argv[2])
@@ -0,0 +1,235 @@
+import os
+import stat
+import pickle
+import socket
+import struct
+import logging
+import threading
+import socketserver
+
+from .io_utils import LORELEIKBLoader, title_to_id_map, id_to_title_map
+from .resources import registry
+
+"""
+    Local lookup server for the KB, the Wikipedia title maps and outlinks.
+
+    The server loads the resources once and answers batched lookups over a
+    Unix domain socket, so worker processes on the same node share one copy
+    instead of each paying the load time and memory. KBClient exposes the
+    same kb[eid] and name2ent[name] interface as io_utils.LORELEIKBLoader.
+
+    Messages are pickled and prefixed with their length as an 8 byte
+    unsigned int. A request is a tuple (table, keys) and the response is a
+    list with the value for each key, or None for keys which aren't found.
+    The socket is created readable only by its owner since requests are
+    unpickled by the server. It is bound with a umask of 077, so it is
+    never accessible to other users, not even between bind and chmod.
+"""
+
+_LENGTH = struct.Struct("!Q")
+
+def _send(sock, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+def _recv_exactly(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+def _remove_stale_socket(socket_path):
+    """Removes a socket left behind by a server which didn't shut down
+    cleanly. Anything else at the path is left alone."""
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError("%s exists and isn't a socket" % socket_path)
+    os.remove(socket_path)
+
+def _recv(sock):
+    """Returns the next message or None if the peer closed the connection."""
+    header = _recv_exactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+    return pickle.loads(_recv_exactly(sock, _LENGTH.unpack(header)[0]))
+
+class _Handler(socketserver.BaseRequestHandler):
+    """Answers requests on one client connection until it is closed."""
+
+    def handle(self):
+        while True:
+            request = _recv(self.request)
+            if request is None:
+                return
+            table, keys = request
+            try:
+                response = self.server.lookup(table, keys)
+            except Exception as e:
+                logging.exception("failed to answer request for %s", table)
+                response = e
+            _send(self.request, response)
+
+class KBServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+        Serves lookups into a set of tables over a Unix domain socket. A table
+        is anything supporting table[key], e.g. LORELEIKBLoader.kb.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, tables):
+        """
+            @param: socket_path, path of the Unix socket to listen on
+            @param: tables, dict of table name to table
+        """
+        _remove_stale_socket(socket_path)
+        self.tables = tables
+        self.num_requests = 0
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, _Handler)
+        finally:
+            os.umask(umask)
+        os.chmod(socket_path, 0o600)
+
+    def lookup(self, table, keys):
+        """
+            @param: table, name of the table
+            @param: keys, list of keys
+            @return: list of values, None for missing keys
+        """
+        self.num_requests += 1
+        if table == "tables":
+            return sorted(self.tables)
+        store = self.tables[table]
+        values = []
+        for key in keys:
+            try:
+                values.append(store[key])
+            except KeyError:
+                values.append(None)
+        return values
+
+class RemoteTable:
+    """Client side view of one of the server's tables."""
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+
+    def get_many(self, keys):
+        """
+            Looks up many keys in one round trip.
+
+            @param: keys, list of keys
+            @return: list of values, None for missing keys
+        """
+        return self.client.request(self.table, list(keys))
+
+    def get(self, key, default=None):
+        value = self.get_many([key])[0]
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get_many([key])[0]
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get_many([key])[0] is not None
+
+class KBClient:
+    """
+        Client for a KBServer. The kb and name2ent attributes behave like
+        those of io_utils.LORELEIKBLoader, title_to_id and id_to_title
+        like the maps of io_utils.title_to_id_map and id_to_title_map and
+        outlinks like the map of io_utils.outlinks.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.lock = threading.Lock()
+        self.sock = None
+        self.pid = None
+        self.kb = RemoteTable(self, "kb")
+        self.name2ent = RemoteTable(self, "name2ent")
+        self.title_to_id = RemoteTable(self, "title_to_id")
+        self.id_to_title = RemoteTable(self, "id_to_title")
+        self.outlinks = RemoteTable(self, "outlinks")
+
+    def _connect(self):
+        # forked children can't share the parent's connection
+        if self.sock is None or self.pid != os.getpid():
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.socket_path)
+            self.pid = os.getpid()
+        return self.sock
+
+    def request(self, table, keys):
+        """
+            Sends one request to the server.
+
+            @param: table, name of the table
+            @param: keys, list of keys
+            @return: list of values, None for missing keys
+        """
+        with self.lock:
+            sock = self._connect()
+            _send(sock, (table, keys))
+            response = _recv(sock)
+        if response is None:
+            raise ConnectionError("kb server closed the connection")
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def tables(self):
+        """Names of the tables served."""
+        return self.request("tables", [])
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+def serve(kbfile, socket_path, titles=True, outlinks=True):
+    """
+        Loads the kb (and the Wikipedia title maps and outlinks) and serves
+        them until interrupted.
+
+        @param: kbfile, the path to source kb
+        @param: socket_path, path of the Unix socket to listen on
+        @param: titles, whether to serve the title <-> id maps as well
+        @param: outlinks, whether to serve the outlinks of each title as
+                well, from the "outlinks" resource
+    """
+    kb = LORELEIKBLoader(kbfile)
+    tables = {"kb": kb.kb, "name2ent": kb.name2ent}
+    if titles:
+        tables["title_to_id"] = title_to_id_map()
+        tables["id_to_title"] = id_to_title_map()
+    if outlinks:
+        tables["outlinks"] = registry.get("outlinks")
+    server = KBServer(socket_path, tables)
+    logging.info("serving %s on %s", ", ".join(sorted(tables)), socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("shutting down kb server")
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+if __name__=="__main__":
+    import sys
+    logging.basicConfig(format=':%(levelname)s: %(message)s', level=logging.INFO)
+    # python -m utils.kb_server kbfile socket_path [notitles] [nooutlinks]
+    serve(sys.argv[1], sys.argv[2], titles="notitles" not in sys.argv[3:],
+          outlinks="nooutlinks" not in sys.argv[3:])
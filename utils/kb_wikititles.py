@@ -0,0 +1,142 @@
+import os
+import json
+import logging
+from urllib import parse
+
+import numpy as np
+
+from .string_heap import StringHeapWriter, StringHeap
+
+"""
+    Precomputed index from KB entity ids to their English Wikipedia titles.
+
+    The titles are pulled out of the external_link field once, with the
+    same rsplit and unquote that evaluation does per gold mention, so
+    resolving the gold title of an entity is a single lookup.
+
+    Layout of an index directory:
+        meta.json
+        eids.npy                   sorted int64 ids of entities with a title
+        first.npy                  index of each entity's first title, len(eids)+1
+        titles.heap, titles.offsets.npy
+"""
+
+def extract_wikititles(external_link):
+    """
+        Extracts English Wikipedia titles from the external_link field of a
+        kb record.
+
+            "http://en.wikipedia.org/wiki/Addis_Ababa|..." -> ["Addis_Ababa"]
+
+        @param: external_link, "|" separated list of links
+        @return: list of unquoted titles, empty if there are none
+    """
+    titles = []
+    for link in external_link.split("|"):
+        if "en.wikipedia" in link:
+            titles.append(parse.unquote(link.rsplit('/', 1)[-1]))
+    return titles
+
+def build_wikititle_index(records, outdir):
+    """
+        Builds the title index from kb records. Entities without an English
+        Wikipedia link are left out; if an id occurs more than once the
+        record is chosen with io_utils.kb_record_date, as it is in the kb
+        stores.
+
+        @param: records, iterable of kb records (see io_utils.read_kb_records)
+        @param: outdir, directory to write the index to
+        @return: the number of entities with at least one title
+    """
+    # imported here since io_utils itself imports from this module
+    from .io_utils import kb_record_date
+    entity_titles = {}
+    dates = {}
+    for endict in records:
+        try:
+            eid = int(endict['entityid'])
+        except ValueError:
+            continue
+        date = kb_record_date(endict)
+        if eid in dates and date < dates[eid]:
+            continue
+        dates[eid] = date
+        titles = extract_wikititles(endict.get('external_link', ''))
+        if titles:
+            entity_titles[eid] = titles
+        else:
+            entity_titles.pop(eid, None)
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    eids = sorted(entity_titles)
+    first = [0]
+    writer = StringHeapWriter(os.path.join(outdir, "titles"))
+    for eid in eids:
+        for title in entity_titles[eid]:
+            writer.append(title)
+        first.append(first[-1] + len(entity_titles[eid]))
+    writer.close()
+    np.save(os.path.join(outdir, "eids.npy"), np.asarray(eids, dtype=np.int64))
+    np.save(os.path.join(outdir, "first.npy"), np.asarray(first, dtype=np.int64))
+    with open(os.path.join(outdir, "meta.json"), "w") as f:
+        json.dump({"num_entities": len(eids), "num_titles": first[-1]}, f)
+    logging.info("wrote wikipedia titles of %d entities to %s", len(eids), outdir)
+    return len(eids)
+
+class WikiTitleIndex:
+    """Read only view of an index written by build_wikititle_index."""
+
+    def __init__(self, directory):
+        self.eids = np.load(os.path.join(directory, "eids.npy"), mmap_mode='r')
+        self.first = np.load(os.path.join(directory, "first.npy"), mmap_mode='r')
+        self.heap = StringHeap(os.path.join(directory, "titles"))
+
+    def titles(self, eid):
+        """
+            @param: eid, entity id as int or string
+            @return: list of English Wikipedia titles of the entity or None,
+                     like data_utils.get_wikititle
+        """
+        try:
+            eid = int(eid)
+        except ValueError:
+            return None
+        pos = np.searchsorted(self.eids, eid)
+        if pos < len(self.eids) and self.eids[pos] == eid:
+            return [self.heap[i] for i in range(self.first[pos], self.first[pos+1])]
+        return None
+
+    def title(self, eid):
+        """
+            @param: eid, entity id as int or string
+            @return: the first English Wikipedia title of the entity or None
+        """
+        titles = self.titles(eid)
+        return titles[0] if titles else None
+
+    def titles_many(self, eids):
+        """
+            Batched title.
+
+            @param: eids, iterable of entity ids
+            @return: list with the first title of each entity or None
+        """
+        keys = []
+        for eid in eids:
+            try:
+                keys.append(int(eid))
+            except ValueError:
+                keys.append(-1)
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.eids) == 0:
+            return [None] * len(keys)
+        pos = np.minimum(np.searchsorted(self.eids, keys), len(self.eids) - 1)
+        found = self.eids[pos] == keys
+        return [self.heap[int(self.first[p])] if f else None for p, f in zip(pos, found)]
+
+    def __contains__(self, eid):
+        return self.titles(eid) is not None
+
+    def __len__(self):
+        return len(self.eids)
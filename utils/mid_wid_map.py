@@ -0,0 +1,140 @@
+import os
+import json
+import logging
+
+import numpy as np
+
+from .string_heap import MapView
+
+"""
+    Bidirectional map between Freebase ids (mids) and Wikipedia page ids
+    (wids), built from mid.wikipedia_en_id in one pass.
+
+    Both directions are sorted arrays which are memory mapped on load, so
+    one small store replaces the two pickled dicts. Mids are ASCII strings
+    like "m.07cw4" and are stored as a fixed width bytes array, which lets
+    numpy's searchsorted look them up in batches.
+
+    Layout of a store directory:
+        meta.json
+        mids.npy          sorted mids
+        mid_wids.npy      int64 wid of each mid
+        wids.npy          sorted int64 wids
+        wid_mids.npy      int64 index into mids.npy of the mid of each wid
+"""
+
+def format_mid(mid):
+    """
+        Formats a string which represents a Freebase id (mid) from
+        the format used in FB15K-237 to that which is used in the cogcomp
+        Wikipedia data files. Namely,
+
+            "/m/07cw4"->"m.07cw4"
+        @param mid, string of mid to be reformatted
+    """
+    return mid[1::].replace("/",".")
+
+def build_mid_wid_map(mid2wid_file, outdir):
+    """
+        Builds the store from a tsv of mid and wid. If a mid or a wid occurs
+        more than once its last line wins, as it did for the pickled dicts.
+
+        @param: mid2wid_file, a tsv which maps MIDs to Wikipedia page ids
+        @param: outdir, directory to write the store to
+        @return: the number of lines read
+    """
+    mids, wids = [], []
+    with open(mid2wid_file, "r") as f:
+        for line in f:
+            spline = line.strip().split("\t")
+            if len(spline) != 2:
+                continue
+            try:
+                wids.append(int(spline[1]))
+            except ValueError:
+                continue
+            mids.append(spline[0])
+    mids = np.asarray(mids, dtype=np.bytes_)
+    wids = np.asarray(wids, dtype=np.int64)
+
+    def last_of_each(keys):
+        """Indices of the last occurrence of each key, in sorted key order."""
+        reverse = keys[::-1]
+        _, first = np.unique(reverse, return_index=True)
+        return len(keys) - 1 - first
+
+    by_mid = last_of_each(mids)
+    sorted_mids = mids[by_mid]
+    by_wid = last_of_each(wids)
+    sorted_wids = wids[by_wid]
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    np.save(os.path.join(outdir, "mids.npy"), sorted_mids)
+    np.save(os.path.join(outdir, "mid_wids.npy"), wids[by_mid])
+    np.save(os.path.join(outdir, "wids.npy"), sorted_wids)
+    # every mid of a line is in sorted_mids, so this finds exact matches
+    np.save(os.path.join(outdir, "wid_mids.npy"),
+            np.searchsorted(sorted_mids, mids[by_wid]).astype(np.int64))
+    with open(os.path.join(outdir, "meta.json"), "w") as f:
+        json.dump({"source": os.path.abspath(mid2wid_file), "num_lines": int(len(mids)),
+                   "num_mids": int(len(sorted_mids)), "num_wids": int(len(sorted_wids))}, f)
+    logging.info("wrote map of %d mids and %d wids to %s", len(sorted_mids), len(sorted_wids), outdir)
+    return len(mids)
+
+class MidWidMap:
+    """Read only view of a store written by build_mid_wid_map."""
+
+    def __init__(self, directory):
+        self.mids = np.load(os.path.join(directory, "mids.npy"), mmap_mode='r')
+        self.mid_wids = np.load(os.path.join(directory, "mid_wids.npy"), mmap_mode='r')
+        self.wids = np.load(os.path.join(directory, "wids.npy"), mmap_mode='r')
+        self.wid_mids = np.load(os.path.join(directory, "wid_mids.npy"), mmap_mode='r')
+        # dict like views with the string keys and values of the old pickles
+        self.mid2wid = MapView(self.mids_to_wids)
+        self.wid2mid = MapView(self.wids_to_mids)
+
+    def mids_to_wids(self, mids):
+        """
+            @param: mids, sequence of mids
+            @return: list with the wid of each mid as a string, None if the
+                     mid isn't in the map
+        """
+        if len(self.mids) == 0:
+            return [None] * len(mids)
+        keys = np.asarray([mid.encode('utf-8') for mid in mids], dtype=np.bytes_)
+        pos = np.minimum(np.searchsorted(self.mids, keys), len(self.mids) - 1)
+        found = self.mids[pos] == keys
+        return [str(w) if f else None for w, f in zip(self.mid_wids[pos], found)]
+
+    def wids_to_mids(self, wids):
+        """
+            @param: wids, sequence of wids as ints or strings
+            @return: list with the mid of each wid, None if the wid isn't in
+                     the map
+        """
+        keys = np.empty(len(wids), dtype=np.int64)
+        for i, wid in enumerate(wids):
+            try:
+                keys[i] = int(wid)
+            except (TypeError, ValueError):
+                keys[i] = -1
+        if len(self.wids) == 0:
+            return [None] * len(keys)
+        pos = np.minimum(np.searchsorted(self.wids, keys), len(self.wids) - 1)
+        found = self.wids[pos] == keys
+        return [self.mids[m].decode('utf-8') if f else None for m, f in zip(self.wid_mids[pos], found)]
+
+def load_mid_wid_map(mid2wid_file, directory):
+    """
+        Loads the store in directory, building it from mid2wid_file first
+        if it doesn't exist yet.
+
+        @param: mid2wid_file, a tsv which maps MIDs to Wikipedia page ids
+        @param: directory, where the store is kept
+        @return: a MidWidMap
+    """
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+        logging.info("mid wid map not found in %s. Building it.", directory)
+        build_mid_wid_map(mid2wid_file, directory)
+    return MidWidMap(directory)
@@ -0,0 +1,159 @@
+import os
+import json
+import bisect
+import logging
+import unicodedata
+
+import numpy as np
+
+from .string_heap import write_string_heap, StringHeap, EncodedStrings
+
+"""
+    Immutable index from normalized KB names to entity ids.
+
+    Both the name and the asciiname of every record are normalized (see
+    normalize_name) and stored as a sorted string heap. The entity ids of
+    each name are stored contiguously in one int64 array, so an exact
+    lookup is a binary search over the names followed by a slice, and a
+    prefix lookup is two binary searches.
+
+    Layout of an index directory:
+        meta.json
+        names.heap, names.offsets.npy    sorted, unique normalized names
+        postings_offsets.npy             start of each name's ids in postings
+        postings.npy                     sorted entity ids per name
+"""
+
+def normalize_name(name):
+    """
+        Normalizes a name for lookup: diacritics are stripped, case is
+        folded and runs of whitespace are collapsed to a single space.
+
+            "  Zürich " -> "zurich"
+
+        @param: name, the string to normalize
+        @return: the normalized string
+    """
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split())
+
+class NameIndexBuilder:
+    """Collects (name, entity id) pairs from kb records and writes a NameIndex."""
+
+    def __init__(self):
+        self.pairs = set()
+
+    def add(self, endict):
+        """
+            Adds the name and asciiname of a record to the index.
+
+            @param: endict, a kb record
+        """
+        try:
+            eid = int(endict['entityid'])
+        except ValueError:
+            return
+        for field in ('name', 'asciiname'):
+            if field in endict:
+                key = normalize_name(endict[field])
+                if key:
+                    self.pairs.add((key, eid))
+
+    def collect(self, records):
+        """
+            Passes records through unchanged while adding them to the index,
+            so the index can be built during another pass over the kb.
+
+            @param: records, iterable of kb records
+            @return: generator of the same records
+        """
+        for endict in records:
+            self.add(endict)
+            yield endict
+
+    def write(self, outdir):
+        """
+            Writes the index to a directory.
+
+            @param: outdir, directory to write the index to
+            @return: the number of distinct names in the index
+        """
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        # str ordering is code point ordering, which is also the byte
+        # ordering of the UTF-8 encoded heap that lookups search
+        pairs = sorted(self.pairs)
+        names = []
+        postings_offsets = [0]
+        postings = np.empty(len(pairs), dtype=np.int64)
+        for i, (key, eid) in enumerate(pairs):
+            if not names or names[-1] != key:
+                if names:
+                    postings_offsets.append(i)
+                names.append(key)
+            postings[i] = eid
+        postings_offsets.append(len(pairs))
+        if not names:
+            postings_offsets = [0]
+
+        write_string_heap(names, os.path.join(outdir, "names"))
+        np.save(os.path.join(outdir, "postings_offsets.npy"), np.asarray(postings_offsets, dtype=np.int64))
+        np.save(os.path.join(outdir, "postings.npy"), postings)
+        with open(os.path.join(outdir, "meta.json"), "w") as f:
+            json.dump({"num_names": len(names), "num_postings": len(pairs)}, f)
+        logging.info("wrote name index with %d names to %s", len(names), outdir)
+        return len(names)
+
+class NameIndex:
+    """Read only view of an index written by NameIndexBuilder."""
+
+    def __init__(self, directory):
+        self.names = StringHeap(os.path.join(directory, "names"))
+        self.postings_offsets = np.load(os.path.join(directory, "postings_offsets.npy"), mmap_mode='r')
+        self.postings = np.load(os.path.join(directory, "postings.npy"), mmap_mode='r')
+        self._encoded = EncodedStrings(self.names)
+
+    def _eids(self, i):
+        """Returns the entity ids of the ith name as strings, the type of kb keys."""
+        start, end = self.postings_offsets[i], self.postings_offsets[i+1]
+        return [str(eid) for eid in self.postings[start:end]]
+
+    def lookup(self, name):
+        """
+            Case and diacritic insensitive exact lookup.
+
+            @param: name, the surface form to look up
+            @return: list of entity ids whose name or asciiname matches
+        """
+        key = normalize_name(name).encode('utf-8')
+        i = bisect.bisect_left(self._encoded, key)
+        if i < len(self._encoded) and self._encoded[i] == key:
+            return self._eids(i)
+        return []
+
+    def prefix(self, prefix, limit=None):
+        """
+            Enumerates the names starting with a prefix, in sorted order.
+
+            @param: prefix, prefix of the surface form, normalized like names
+            @param: limit, maximum number of names to return
+            @return: generator of (normalized name, list of entity ids)
+        """
+        key = normalize_name(prefix).encode('utf-8')
+        lo = bisect.bisect_left(self._encoded, key)
+        # 0xff never occurs in UTF-8 so this sorts after every name with the prefix
+        hi = bisect.bisect_left(self._encoded, key + b'\xff', lo)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        for i in range(lo, hi):
+            yield self.names[i], self._eids(i)
+
+    def __contains__(self, name):
+        return len(self.lookup(name)) > 0
+
+    def __getitem__(self, name):
+        eids = self.lookup(name)
+        if not eids:
+            raise KeyError(name)
+        return eids
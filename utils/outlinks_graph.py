@@ -0,0 +1,398 @@
+import mmap
+import struct
+import logging
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+"""
+    Compressed sparse row (CSR) representation of the Wikipedia outlinks.
+
+    Every title, whether it has outlinks or is only linked to, gets an
+    integer id; ids are assigned in sorted title order. The outlinks of
+    page s are indices[indptr[s]:indptr[s+1]], sorted, with the number of
+    times s links to each of them in the same slice of counts. Counting
+    the links from one page to another is a binary search in that slice.
+
+    Compared to the map built by io_utils.outlinks, which holds a Python
+    string for every link, the graph holds 8 bytes per distinct link plus
+    one string per title.
+
+    save_outlinks_graph writes the graph to a single binary file which
+    load_outlinks_graph memory maps, so opening it takes milliseconds and
+    its pages are shared through the page cache by every process using it.
+    The file is laid out as
+
+        header          magic, version, number of titles, number of edges
+                        and the byte offset of each section below
+        title offsets   int64, number of titles + 1
+        title heap      UTF-8 encoded titles in sorted order
+        indptr          int64, number of titles + 1
+        indices         int32, number of edges
+        counts          int32, number of edges
+
+    with every section starting on an 8 byte boundary.
+"""
+
+_MAGIC = b"OUTLINKS"
+_VERSION = 1
+# magic, version, number of titles, number of edges, offsets of the 5 sections
+_HEADER = struct.Struct("<8sQQQ5Q")
+
+class OutlinksGraph:
+    """Outlinks between Wikipedia titles as a CSR graph of integer ids."""
+
+    def __init__(self, titles, indptr, indices, counts):
+        """
+            @param: titles, sorted sequence of titles, the position of a title
+                    is its id. Must support index(title), see title_ids.
+            @param: indptr, int64 array of len(titles)+1 row offsets
+            @param: indices, int32 array of sorted neighbor ids per row
+            @param: counts, int32 array of link multiplicities
+        """
+        self.titles = titles
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def num_edges(self):
+        return len(self.indices)
+
+    def title_id(self, title):
+        """
+            @param: title, a Wikipedia title
+            @return: the id of the title or None if it isn't in the graph
+        """
+        return self.titles.index(title)
+
+    def count_ids(self, src, dest):
+        """
+            Number of links from page id src to page id dest.
+        """
+        lo, hi = self.indptr[src], self.indptr[src+1]
+        pos = lo + np.searchsorted(self.indices[lo:hi], dest)
+        if pos < hi and self.indices[pos] == dest:
+            return int(self.counts[pos])
+        return 0
+
+    def count(self, src, dest):
+        """
+            Number of links from the page of title src to the page of title
+            dest, the same as io_utils.outlinks(...)[src].count(dest).
+
+            @param: src, the source title
+            @param: dest, the destination title
+            @return: the number of links from src to dest
+        """
+        s = self.title_id(src)
+        if s is None:
+            return 0
+        d = self.title_id(dest)
+        if d is None:
+            return 0
+        return self.count_ids(s, d)
+
+    def neighbors(self, title):
+        """
+            @param: title, the source title
+            @return: list of (destination title, number of links)
+        """
+        s = self.title_id(title)
+        if s is None:
+            return []
+        lo, hi = self.indptr[s], self.indptr[s+1]
+        return [(self.titles[int(d)], int(c)) for d, c in zip(self.indices[lo:hi], self.counts[lo:hi])]
+
+    def __contains__(self, title):
+        s = self.title_id(title)
+        return s is not None and self.indptr[s+1] > self.indptr[s]
+
+    def __getitem__(self, title):
+        """
+            Outlinks of a title as a list with one entry per link, like the
+            values of the map returned by io_utils.outlinks.
+        """
+        if title not in self:
+            raise KeyError(title)
+        links = []
+        for dest, count in self.neighbors(title):
+            links.extend([dest] * count)
+        return links
+
+    def link_counts(self, titles):
+        """
+            Counts the links in both directions between every pair of titles
+            at once. Titles are deduplicated and the counts are read off the
+            rows of the graph as a sparse matrix, instead of one binary search
+            per pair of titles.
+
+            @param: titles, iterable of titles, e.g. all candidate titles of a
+                    document. Titles which aren't in the graph have no links.
+            @return: a LinkCounts
+        """
+        unique = list(dict.fromkeys(titles))
+        ids = np.asarray([-1 if i is None else i for i in map(self.title_id, unique)], dtype=np.int64)
+        present = np.flatnonzero(ids >= 0)
+        # graph ids of the titles in sorted order, with their position in unique
+        order = present[np.argsort(ids[present])]
+        sorted_ids = ids[order]
+
+        rows, cols, vals = [], [], []
+        for pos, src in zip(order, sorted_ids):
+            lo, hi = self.indptr[src], self.indptr[src+1]
+            if lo == hi:
+                continue
+            dests = np.asarray(self.indices[lo:hi])
+            hit = np.searchsorted(sorted_ids, dests)
+            hit[hit == len(sorted_ids)] = 0
+            keep = sorted_ids[hit] == dests
+            cols.append(order[hit[keep]])
+            vals.append(np.asarray(self.counts[lo:hi])[keep])
+            rows.append(np.full(len(cols[-1]), pos, dtype=np.int64))
+        n = len(unique)
+        if rows:
+            links = sp.coo_matrix((np.concatenate(vals).astype(np.int64),
+                                   (np.concatenate(rows), np.concatenate(cols))), shape=(n, n)).tocsr()
+        else:
+            links = sp.csr_matrix((n, n), dtype=np.int64)
+        return LinkCounts(unique, links + links.T)
+
+    def document_link_counts(self, candidates, max_cands=None):
+        """
+            Link counts between the candidates of every pair of mentions of a
+            document, see LinkCounts.tensor.
+
+            @param: candidates, list with the list of candidate titles of each mention
+            @param: max_cands, number of candidates per mention to keep
+            @return: m x m x max_cands x max_cands array
+        """
+        return self.link_counts(t for cands in candidates for t in cands[:max_cands]).tensor(candidates, max_cands)
+
+class LinkCounts:
+    """
+        Symmetric link counts between a set of titles, the count of a pair is
+        the number of links from the first title to the second plus the number
+        of links from the second to the first.
+    """
+
+    def __init__(self, titles, matrix):
+        """
+            @param: titles, list of distinct titles
+            @param: matrix, sparse symmetric matrix of counts indexed like titles
+        """
+        self.titles = titles
+        self.index = {title: i for i, title in enumerate(titles)}
+        self.matrix = matrix
+
+    def count(self, t1, t2):
+        """
+            @return: the number of links between t1 and t2 in both directions,
+                     0 if either title isn't one of the titles
+        """
+        i = self.index.get(t1)
+        j = self.index.get(t2)
+        if i is None or j is None:
+            return 0
+        return int(self.matrix[i, j])
+
+    def __contains__(self, title):
+        return title in self.index
+
+    def tensor(self, candidates, max_cands=None):
+        """
+            Link counts between the candidates of every pair of mentions.
+
+            @param: candidates, list with the list of candidate titles of each
+                    mention, all of them among the titles
+            @param: max_cands, number of candidates per mention to keep, the
+                    longest list by default. Shorter lists are padded with 0.
+            @return: m x m x max_cands x max_cands array where [i,j,k,l] is the
+                     count between candidate k of mention i and candidate l of
+                     mention j
+        """
+        if max_cands is None:
+            max_cands = max([len(cands) for cands in candidates] or [0])
+        n = len(self.titles)
+        # the padding candidates point at an extra row and column of zeros
+        positions = np.full((len(candidates), max_cands), n, dtype=np.int64)
+        for i, cands in enumerate(candidates):
+            for k, title in enumerate(cands[:max_cands]):
+                positions[i, k] = self.index[title]
+        dense = np.zeros((n + 1, n + 1), dtype=np.int64)
+        dense[:n, :n] = self.matrix.toarray()
+        return dense[positions[:, None, :, None], positions[None, :, None, :]]
+
+def off_diagonal(tensor):
+    """
+        Drops the pairs of a mention with itself from a tensor returned by
+        LinkCounts.tensor, giving the m x m-1 x ... layout of the pairwise
+        feature matrices. The second index of mention j for mention i is j
+        if j < i and j-1 if j > i.
+
+        @param: tensor, m x m x ... array
+        @return: m x m-1 x ... array
+    """
+    m = tensor.shape[0]
+    keep = ~np.eye(m, dtype=bool)
+    return tensor[keep].reshape((m, m - 1) + tensor.shape[2:])
+
+class TitleIds:
+    """Sorted list of titles with a dict for title to id lookups."""
+
+    def __init__(self, titles):
+        self.titles = titles
+        self.ids = {title: i for i, title in enumerate(titles)}
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __getitem__(self, i):
+        return self.titles[i]
+
+    def index(self, title):
+        return self.ids.get(title)
+
+def build_outlinks_graph(pages):
+    """
+        Builds an OutlinksGraph in one pass over pages. If a title occurs
+        more than once its last list of outlinks is kept.
+
+        @param: pages, iterable of (title, list of outlink titles), e.g.
+                io_utils.iter_outlinks(outlinks_file)
+        @return: an OutlinksGraph
+    """
+    start = time.time()
+    # provisional ids in order of first appearance, remapped to sorted order below
+    ids = {}
+    rows = {}
+    for title, links in pages:
+        src = ids.setdefault(title, len(ids))
+        dests = np.fromiter((ids.setdefault(link, len(ids)) for link in links),
+                            dtype=np.int64, count=len(links))
+        rows[src] = np.unique(dests, return_counts=True)
+
+    titles = sorted(ids)
+    rank = np.empty(len(ids), dtype=np.int64)
+    for i, title in enumerate(titles):
+        rank[ids[title]] = i
+    del ids
+
+    sizes = np.zeros(len(titles) + 1, dtype=np.int64)
+    for src, (dests, _) in rows.items():
+        sizes[rank[src] + 1] = len(dests)
+    indptr = np.cumsum(sizes)
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    counts = np.empty(indptr[-1], dtype=np.int32)
+    for src, (dests, dest_counts) in rows.items():
+        s = rank[src]
+        dests = rank[dests]
+        order = np.argsort(dests)
+        indices[indptr[s]:indptr[s+1]] = dests[order]
+        counts[indptr[s]:indptr[s+1]] = dest_counts[order]
+
+    logging.info("built outlinks graph with %d titles and %d edges in %.1fs",
+                 len(titles), len(indices), time.time() - start)
+    return OutlinksGraph(TitleIds(titles), indptr, indices, counts)
+
+class HeapTitles:
+    """
+        Sorted titles stored as a UTF-8 heap with offsets, looked up with a
+        binary search. Used by graphs loaded with load_outlinks_graph.
+    """
+
+    def __init__(self, offsets, data, base=0):
+        """
+            @param: offsets, int64 array of len(titles)+1 offsets into the heap
+            @param: data, buffer holding the heap, slicing it must give bytes
+            @param: base, position of the heap in data
+        """
+        self.offsets = offsets
+        self.data = data
+        self.base = base
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _raw(self, i):
+        return self.data[self.base + int(self.offsets[i]):self.base + int(self.offsets[i+1])]
+
+    def __getitem__(self, i):
+        return self._raw(i).decode('utf-8')
+
+    def index(self, title):
+        key = title.encode('utf-8')
+        lo, hi = 0, len(self)
+        # bisect over the raw bytes, UTF-8 preserves the order of the titles
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._raw(lo) == key:
+            return lo
+        return None
+
+def _align(f):
+    """Pads the file to an 8 byte boundary and returns the offset."""
+    pad = -f.tell() % 8
+    f.write(b"\0" * pad)
+    return f.tell()
+
+def save_outlinks_graph(graph, path):
+    """
+        Writes a graph to the binary format read by load_outlinks_graph.
+
+        @param: graph, an OutlinksGraph
+        @param: path, file to write
+    """
+    title_offsets = [0]
+    with open(path, "wb") as f:
+        f.write(b"\0" * _HEADER.size)
+        encoded = []
+        for i in range(len(graph.titles)):
+            b = graph.titles[i].encode('utf-8')
+            encoded.append(b)
+            title_offsets.append(title_offsets[-1] + len(b))
+        offsets_start = _align(f)
+        f.write(np.asarray(title_offsets, dtype=np.int64).tobytes())
+        heap_start = _align(f)
+        for b in encoded:
+            f.write(b)
+        del encoded
+        indptr_start = _align(f)
+        f.write(np.asarray(graph.indptr, dtype=np.int64).tobytes())
+        indices_start = _align(f)
+        f.write(np.asarray(graph.indices, dtype=np.int32).tobytes())
+        counts_start = _align(f)
+        f.write(np.asarray(graph.counts, dtype=np.int32).tobytes())
+        f.seek(0)
+        f.write(_HEADER.pack(_MAGIC, _VERSION, len(graph.titles), graph.num_edges,
+                             offsets_start, heap_start, indptr_start, indices_start, counts_start))
+    logging.info("wrote outlinks graph with %d titles and %d edges to %s",
+                 len(graph.titles), graph.num_edges, path)
+
+def load_outlinks_graph(path):
+    """
+        Memory maps a graph written by save_outlinks_graph.
+
+        @param: path, file written by save_outlinks_graph
+        @return: an OutlinksGraph backed by the file
+    """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, num_titles, num_edges, offsets_start, heap_start, \
+        indptr_start, indices_start, counts_start = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("%s is not an outlinks graph file" % path)
+    title_offsets = np.frombuffer(data, dtype=np.int64, count=num_titles + 1, offset=offsets_start)
+    titles = HeapTitles(title_offsets, data, heap_start)
+    indptr = np.frombuffer(data, dtype=np.int64, count=num_titles + 1, offset=indptr_start)
+    indices = np.frombuffer(data, dtype=np.int32, count=num_edges, offset=indices_start)
+    counts = np.frombuffer(data, dtype=np.int32, count=num_edges, offset=counts_start)
+    return OutlinksGraph(titles, indptr, indices, counts)
@@ -0,0 +1,176 @@
+import os
+import pickle
+import hashlib
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+
+from .cache_stats import CacheStatsMixin
+
+"""
+    Bounded LRU cache of pairwise title features shared across documents.
+
+    Popular entities occur in most documents of a corpus, so the same
+    pairs of candidate titles get their features computed again and again.
+    The features are symmetric, so a pair is cached under its titles in
+    sorted order and (yi, yj) and (yj, yi) share one entry. Entries are
+    kept per namespace since the feature extractor and StarModel compute
+    different vectors for a pair. A namespace also identifies the resources
+    the features were computed from, see resource_key and titles_key, so
+    users of different resources never share entries.
+
+    A snapshot of the cache can be saved at the end of a run and loaded
+    at the start of the next one. Snapshots are only valid as long as the
+    resources the features are computed from don't change.
+"""
+
+def titles_key(titles):
+    """
+        @param: titles, collection of titles, e.g. a title vocabulary, or None
+        @return: digest of the set of titles for use in a namespace, None for None
+    """
+    if titles is None:
+        return None
+    digest = hashlib.sha1()
+    for title in sorted(set(titles)):
+        digest.update(title.encode('utf-8') + b"\n")
+    return digest.hexdigest()
+
+# tokens of resources which don't carry a cache_key
+_tokens = itertools.count()
+
+def resource_key(resource):
+    """
+        Identifies a resource features are computed from, for use in a
+        namespace. Resources read from disk carry a cache_key, e.g. the
+        graphs of io_utils.outlinks_graph, which stays valid across
+        processes and snapshots. Other objects get a token unique to them in
+        this process, or their id if they don't take attributes.
+
+        @param: resource, e.g. an outlinks map, or None
+        @return: a hashable key
+    """
+    if resource is None:
+        return None
+    key = getattr(resource, "cache_key", None)
+    if key is not None:
+        return key
+    try:
+        key = ("object", os.getpid(), next(_tokens))
+        resource.cache_key = key
+    except AttributeError:
+        key = ("id", os.getpid(), id(resource))
+    return key
+
+class PairFeatureCache(CacheStatsMixin):
+    """LRU cache of feature vectors keyed by an unordered pair of titles."""
+    stats_name = "pair feature"
+
+    def __init__(self, maxsize=1000000):
+        """
+            @param: maxsize, maximum number of pairs kept in the cache
+        """
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(namespace, yi, yj):
+        return (namespace, yi, yj) if yi <= yj else (namespace, yj, yi)
+
+    def get(self, namespace, yi, yj):
+        """
+            @param: namespace, which features are cached and what they were
+                    computed from, e.g. ("star", 6, resource_key(outlinks_map))
+            @param: yi, first title
+            @param: yj, second title
+            @return: the cached features of the pair or None
+        """
+        key = self.key(namespace, yi, yj)
+        with self.lock:
+            value = self.cache.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return value
+
+    def put(self, namespace, yi, yj, value):
+        """
+            Caches the features of a pair. The array is made read only since
+            it is handed out to every later lookup of the pair.
+        """
+        value.setflags(write=False)
+        key = self.key(namespace, yi, yj)
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def get_or_compute(self, namespace, yi, yj, compute):
+        """
+            @param: compute, function of no arguments computing the features
+                    of the pair on a miss
+            @return: the features of the pair
+        """
+        value = self.get(namespace, yi, yj)
+        if value is None:
+            value = self.put(namespace, yi, yj, compute())
+        return value
+
+    def __len__(self):
+        return len(self.cache)
+
+    def clear(self):
+        """Empties the cache, the counters are kept."""
+        with self.lock:
+            self.cache.clear()
+
+    def save(self, path):
+        """
+            Writes a snapshot of the cache, least recently used first.
+
+            @param: path, file to write
+        """
+        with self.lock:
+            items = list(self.cache.items())
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(items, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        logging.info("saved %d cached pairs to %s", len(items), path)
+
+    def load(self, path):
+        """
+            Warm starts the cache from a snapshot written by save. Pairs
+            already in the cache are kept.
+
+            @param: path, snapshot file
+            @return: the number of pairs loaded
+        """
+        with open(path, "rb") as f:
+            items = pickle.load(f)
+        # keep the most recently used pairs of the snapshot if it doesn't fit
+        items = items[-self.maxsize:]
+        with self.lock:
+            # snapshot pairs go behind the pairs already cached, in their own order
+            for key, value in reversed(items):
+                if key not in self.cache:
+                    value.setflags(write=False)
+                    self.cache[key] = value
+                    self.cache.move_to_end(key, last=False)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        logging.info("loaded %d cached pairs from %s", len(items), path)
+        return len(items)
+
+# cache shared by CoherenceFeatureExtractor and StarModel unless they're given their own
+shared_pair_cache = PairFeatureCache()
@@ -1,11 +1,18 @@
+import os
 import json
+import time
+import shutil
 import logging
 import pickle
+import tempfile
+import multiprocessing
 
 from os import listdir
 from os.path import isfile, join
 from sqlitedict import SqliteDict
 
+from .mid_wid_map import load_mid_wid_map, format_mid
+
 """
     This file contains a bunch of helper functions for preprocessing
     data for LORELEI 2018 EDL.
@@ -16,45 +23,125 @@ WIKI_DUMP_DIR="/shared/preprocessed/wikiparser/wikiExtractorJsonPages/"
 MID2WID="/shared/preprocessed/upadhya3/enwiki-datamachine/mid.wikipedia_en_id"
 WID2TITLE="/shared/preprocessed/upadhya3/enwiki-datamachine/idmap/enwiki-20170520.id2t"
 
-"""
-    Creates a tab separated file with two columns. The first column
-    is Wikipedia title of a given page and the second column is a
-    space separated string of outlinks from that page.
-
-    @param: outfile path to which the resulting file should be written
-"""
-def outlink_counts(outfile):
-    out = open(outfile, "w")
-    wikifiles = \
-        [join(WIKI_DUMP_DIR+"/",f) \
-        for f in listdir(WIKI_DUMP_DIR) if isfile(join(WIKI_DUMP_DIR+"/",f))]
-    proc_ct = 0
-    num_files = len(wikifiles)
-    
-    for wikifile in wikifiles:
-        proc_ct+=1
-        if proc_ct % 10 == 0:
-            logging.info("%f complete"%(proc_ct/float(num_files)))
-        with open(wikifile, "r") as f:
-            for json_str in f.readlines():
-                try:
-                    wiki_page = json.loads(json_str.strip())
-                    out.write(wiki_page["wikiTitle"] + "\t" + " ".join(wiki_page["hyperlinks"].values()) + "\n")
-                except:
-                    logging.info("failed to parse " + wikifile)
-                    out.flush()
-            out.flush()
+def _outlink_lines(wikifile, out):
+    """
+        Writes the outlinks line of every page in one file of the dump.
 
-def format_mid(mid):
+        @param: wikifile, file of json pages, one per line
+        @param: out, file to write the lines to
+        @return: tuple of (pages written, pages which failed to parse, bytes read)
+    """
+    num_pages = 0
+    num_failed = 0
+    num_bytes = 0
+    with open(wikifile, "r") as f:
+        for json_str in f:
+            num_bytes += len(json_str)
+            try:
+                wiki_page = json.loads(json_str.strip())
+                out.write(wiki_page["wikiTitle"] + "\t" + " ".join(wiki_page["hyperlinks"].values()) + "\n")
+                num_pages += 1
+            except:
+                num_failed += 1
+    if num_failed:
+        logging.info("failed to parse %d pages of %s" % (num_failed, wikifile))
+    return num_pages, num_failed, num_bytes
+
+# part file of the current worker process, opened by _init_outlinks_worker
+_part = None
+
+def _init_outlinks_worker(part_dir):
+    global _part
+    _part = open(join(part_dir, "part-%d" % os.getpid()), "w")
+
+def _extract_outlinks_file(task):
     """
-        Formats a string which represents a Freebase id (mid) from
-        the format used in FB15K-237 to that which is used in the cogcomp
-        Wikipedia data files. Namely,
+        Appends the outlinks of one dump file to the worker's part file.
 
-            "/m/07cw4"->"m.07cw4"
-        @param mid, string of mid to be reformatted
+        @param: task, tuple of (index of the file, path of the file)
+        @return: tuple of (index, part file, start offset, end offset,
+                 pages written, pages which failed, bytes read)
     """
-    return mid[1::].replace("/",".")
+    index, wikifile = task
+    start = _part.tell()
+    counts = _outlink_lines(wikifile, _part)
+    _part.flush()
+    return (index, _part.name, start, _part.tell()) + counts
+
+class _Progress:
+    """Logs the fraction of files done and the throughput so far."""
+
+    def __init__(self, num_files, every=10):
+        self.num_files = num_files
+        self.every = every
+        self.files = 0
+        self.pages = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.time()
+
+    def update(self, num_pages, num_failed, num_bytes):
+        self.files += 1
+        self.pages += num_pages
+        self.failed += num_failed
+        self.bytes += num_bytes
+        if self.files % self.every == 0 or self.files == self.num_files:
+            elapsed = max(time.time() - self.start, 1e-9)
+            logging.info("%f complete, %d pages (%d failed), %.0f pages/sec, %.1f MB/sec"
+                         % (self.files / float(self.num_files), self.pages, self.failed,
+                            self.pages / elapsed, self.bytes / elapsed / 2**20))
+
+def outlink_counts(outfile, num_workers=1, wiki_dump_dir=WIKI_DUMP_DIR):
+    """
+        Creates a tab separated file with two columns. The first column
+        is Wikipedia title of a given page and the second column is a
+        space separated string of outlinks from that page.
+
+        With more than one worker the dump files are spread over a process
+        pool. Each worker appends the lines of the files it gets to its own
+        part file, and the parts are merged in the sorted order of the dump
+        files, so the output is the same for any number of workers.
+
+        @param: outfile path to which the resulting file should be written
+        @param: num_workers, number of processes to parse the dump with
+        @param: wiki_dump_dir, directory of the json files of the dump
+    """
+    wikifiles = sorted(
+        join(wiki_dump_dir, f) for f in listdir(wiki_dump_dir) if isfile(join(wiki_dump_dir, f)))
+    progress = _Progress(len(wikifiles))
+
+    if num_workers <= 1:
+        with open(outfile, "w") as out:
+            for wikifile in wikifiles:
+                progress.update(*_outlink_lines(wikifile, out))
+        return
+
+    part_dir = tempfile.mkdtemp(prefix="outlinks-", dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        sections = [None] * len(wikifiles)
+        with multiprocessing.Pool(num_workers, _init_outlinks_worker, (part_dir,)) as pool:
+            for result in pool.imap_unordered(_extract_outlinks_file, enumerate(wikifiles)):
+                index, part, start, end = result[:4]
+                sections[index] = (part, start, end)
+                progress.update(*result[4:])
+
+        logging.info("merging %d part files into %s" % (len(listdir(part_dir)), outfile))
+        parts = {}
+        with open(outfile, "wb") as out:
+            for part, start, end in sections:
+                if part not in parts:
+                    parts[part] = open(part, "rb")
+                f = parts[part]
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1 << 24))
+                    out.write(chunk)
+                    remaining -= len(chunk)
+        for f in parts.values():
+            f.close()
+    finally:
+        shutil.rmtree(part_dir)
 
 def build_freebase_relations_dict(mid2wid_file, relation_data_dir, outpath):
     """
@@ -65,19 +152,15 @@ def build_freebase_relations_dict(mid2wid_file, relation_data_dir, outpath):
         Requires a tab separated file for Freebase IDs to Wikipedia page IDs.
         Requires the FB15K-237 dataset which can be downloaded from the Web.
 
-        @param: mid2wid_file, a tsv which mps MIDs to Wikipedia page ids
+        @param: mid2wid_file, a tsv which mps MIDs to Wikipedia page ids, the
+                map is kept in outpath/mid_wid/ after it is first built
         @param: relation_data_dir, directory containing the FB15K-237 dataset
         @param: outpath, path to serialize dict to
     """
     dict_path = outpath+"freebase_relations.pkl" 
     kb = {} 
-    logging.info("Building mid2wid dict.")
-    mid2wid = {}
-
-    with open(mid2wid_file, "r") as f:
-        for line in f.readlines():
-            spline = line.strip().split("\t")
-            mid2wid[spline[0]]=spline[1]
+    logging.info("Loading mid2wid map.")
+    mid2wid = load_mid_wid_map(mid2wid_file, outpath+"mid_wid/").mid2wid
     
     files = ["train.txt","valid.txt","test.txt"]
     count = 0
@@ -120,7 +203,8 @@ def build_freebase_relations_dict(mid2wid_file, relation_data_dir, outpath):
         pickle.dump(kb,f)
 
 if __name__=="__main__":
-    #outlink_counts("/shared/preprocessed/cddunca2/wikipedia/outlinks.t2t")
+    # run from the root of the repo with python -m utils.preprocess
+    #outlink_counts("/shared/preprocessed/cddunca2/wikipedia/outlinks.t2t", num_workers=multiprocessing.cpu_count())
     mid2wid_file="/shared/preprocessed/upadhya3/enwiki-datamachine/mid.wikipedia_en_id"
     relation_data_dir="data/FB15K-237/"
     outpath="resources/"
@@ -0,0 +1,142 @@
+import os
+import time
+import logging
+import threading
+
+from .io_utils import outlinks_graph, load_title_dictionary, load_mid_wid_map, MID2WID, MID_WID_DIR, TITLE_DICT_DIR
+from .freebase_relations import load_freebase_relation_index
+from .freebase_paths import FreebasePaths
+
+"""
+    Registry of the large resources used for feature extraction.
+
+    Every resource is declared once with a default location and a loader.
+    It is loaded the first time it is asked for and then shared by
+    everything in the process, so a run which never touches a resource
+    never pays for loading it.
+
+    Locations can be changed before a resource is loaded, with configure
+    or with an environment variable LORELEI_<NAME>, e.g.
+
+        LORELEI_OUTLINKS=/data/outlinks.t2t python scripts/...
+
+    report logs how long each loaded resource took to load.
+"""
+
+class _Resource:
+    def __init__(self, name, path, loader):
+        self.name = name
+        self.path = os.environ.get("LORELEI_" + name.upper(), path)
+        self.loader = loader
+        self.value = None
+        self.loaded = False
+        self.seconds = None
+        self.identity = None
+
+class ResourceRegistry:
+    """Lazily loaded, process wide resources."""
+
+    def __init__(self):
+        self.resources = {}
+        self.lock = threading.RLock()
+
+    def register(self, name, path, loader):
+        """
+            Declares a resource.
+
+            @param: name, name of the resource
+            @param: path, default location of the resource
+            @param: loader, function from the location to the loaded resource
+        """
+        with self.lock:
+            self.resources[name] = _Resource(name, path, loader)
+
+    def configure(self, **paths):
+        """
+            Changes the locations of resources, e.g.
+            configure(freebase_relations="resources/freebase_relations/").
+            A resource which is already loaded is dropped and loaded again
+            from its new location when it is next used.
+
+            @param: paths, new location of each resource by name
+        """
+        with self.lock:
+            for name, path in paths.items():
+                resource = self.resources[name]
+                if resource.loaded and resource.path != path:
+                    logging.info("resource %s moved to %s, dropping the loaded copy", name, path)
+                    resource.value = None
+                    resource.loaded = False
+                resource.path = path
+                resource.identity = None
+
+    def path(self, name):
+        return self.resources[name].path
+
+    def identity(self, name):
+        """
+            Identifies the version of a resource without loading it, e.g. to
+            tell apart cached features computed from different resources.
+
+            @param: name, name of the resource
+            @return: tuple of (name, absolute path, modification time of the
+                     path or None if it doesn't exist)
+        """
+        resource = self.resources[name]
+        if resource.identity is None:
+            path = os.path.abspath(resource.path)
+            mtime = os.path.getmtime(path) if os.path.exists(path) else None
+            resource.identity = (name, path, mtime)
+        return resource.identity
+
+    def get(self, name):
+        """
+            @param: name, name of the resource
+            @return: the resource, loaded if this is its first use
+        """
+        resource = self.resources[name]
+        if not resource.loaded:
+            with self.lock:
+                if not resource.loaded:
+                    logging.info("loading resource %s from %s", name, resource.path)
+                    start = time.time()
+                    resource.value = resource.loader(resource.path)
+                    resource.seconds = time.time() - start
+                    resource.loaded = True
+                    logging.info("loaded resource %s in %.2fs", name, resource.seconds)
+        return resource.value
+
+    def is_loaded(self, name):
+        return self.resources[name].loaded
+
+    def report(self):
+        """
+            Logs the load time of every resource.
+
+            @return: list of (name, path, seconds to load or None if it
+                     wasn't loaded)
+        """
+        rows = [(r.name, r.path, r.seconds if r.loaded else None)
+                for r in sorted(self.resources.values(), key=lambda r: r.name)]
+        total = sum(seconds for _, _, seconds in rows if seconds is not None)
+        for name, path, seconds in rows:
+            if seconds is None:
+                logging.info("resource %-20s not loaded      %s", name, path)
+            else:
+                logging.info("resource %-20s %8.2fs       %s", name, seconds, path)
+        logging.info("resources took %.2fs to load in total", total)
+        return rows
+
+registry = ResourceRegistry()
+# Wikipedia outlinks, see io_utils.outlinks_graph
+registry.register("outlinks", "/shared/preprocessed/cddunca2/wikipedia/outlinks.t2t", outlinks_graph)
+# number of Freebase relations between pages, see freebase_relations, converted
+# from the freebase_relations.pkl next to it on first use
+registry.register("freebase_relations", "/home/cddunca2/lorelei2018/resources/freebase_relations/",
+                  load_freebase_relation_index)
+# typed and two hop Freebase relatedness of candidate pages, see freebase_paths
+registry.register("freebase_paths", "resources/freebase_paths/", FreebasePaths)
+# Wikipedia page id <-> title, see title_dictionary
+registry.register("titles", TITLE_DICT_DIR, load_title_dictionary)
+# Freebase mid <-> Wikipedia page id, see mid_wid_map
+registry.register("mid_wid", MID_WID_DIR, lambda path: load_mid_wid_map(MID2WID, path))
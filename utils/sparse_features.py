@@ -0,0 +1,97 @@
+import numpy as np
+import tensorflow as tf
+
+"""
+    Sparse (COO) representation of the pairwise feature tensors.
+
+    Most candidate pairs share no links or relations, so nearly every entry
+    of an m x m-1 x c x c x F pairwise tensor is 0. A tensor is stored as
+    the indices of its nonzero entries, their values and its shape. In an
+    npz file these are the arrays <name>_indices (nnz x ndim int64),
+    <name>_values and <name>_shape, next to or instead of the dense <name>.
+
+    pair_features encodes the pairwise tensor of a TFRecord Example for
+    every writer, see write_tfrecords.decode and decode_sparse for the
+    readers.
+"""
+
+def to_coo(dense):
+    """
+        @param: dense, array
+        @return: tuple of (nnz x ndim int64 indices, values, shape)
+    """
+    dense = np.asarray(dense)
+    indices = np.argwhere(dense != 0).astype(np.int64)
+    values = dense[tuple(indices.T)]
+    return indices, values, tuple(dense.shape)
+
+def to_dense(indices, values, shape, dtype=np.float64):
+    """
+        @param: indices, nnz x ndim indices of the nonzero entries
+        @param: values, the nonzero entries
+        @param: shape, shape of the tensor
+        @return: the dense array
+    """
+    dense = np.zeros(tuple(shape), dtype=dtype)
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1, len(shape))
+    dense[tuple(indices.T)] = values
+    return dense
+
+def coo_arrays(name, dense):
+    """
+        Arrays to pass to np.savez to store a tensor sparsely, e.g.
+        np.savez(path, single=single, **coo_arrays("pair", pair), truth=truth)
+
+        @param: name, name of the tensor in the npz file
+        @param: dense, the tensor
+        @return: dict of array name to array
+    """
+    indices, values, shape = to_coo(dense)
+    return {name + "_indices": indices, name + "_values": values,
+            name + "_shape": np.asarray(shape, dtype=np.int64)}
+
+def load_coo(data, name):
+    """
+        Reads a tensor from an npz file as COO, whether it was stored dense
+        or with coo_arrays.
+
+        @param: data, the loaded npz file
+        @param: name, name of the tensor
+        @return: tuple of (indices, values, shape)
+    """
+    if name + "_indices" in data:
+        return data[name + "_indices"], data[name + "_values"], tuple(data[name + "_shape"])
+    return to_coo(data[name])
+
+def load_dense(data, name):
+    """
+        Reads a tensor from an npz file as a dense array, whether it was
+        stored dense or with coo_arrays.
+
+        @param: data, the loaded npz file
+        @param: name, name of the tensor
+        @return: the dense array
+    """
+    if name + "_indices" in data:
+        return to_dense(*load_coo(data, name))
+    return data[name]
+
+def pair_features(pair_shape, pair, sparse=False):
+    """
+        Features of an Example for a pairwise tensor: pair_shp and either the
+        flattened dense tensor as pair or, with sparse, the COO tensor as
+        pair_indices (flattened nnz x 5) and pair_values.
+
+        @param: pair_shape, shape of the tensor
+        @param: pair, the flattened tensor or with sparse (indices, values)
+        @param: sparse, whether to store the tensor as COO
+        @return: dict of feature name to tf.train.Feature
+    """
+    features = {'pair_shp': tf.train.Feature(int64_list=tf.train.Int64List(value=list(pair_shape)))}
+    if sparse:
+        indices, values = pair
+        features['pair_indices'] = tf.train.Feature(int64_list=tf.train.Int64List(value=np.ravel(indices)))
+        features['pair_values'] = tf.train.Feature(float_list=tf.train.FloatList(value=values))
+    else:
+        features['pair'] = tf.train.Feature(float_list=tf.train.FloatList(value=pair))
+    return features
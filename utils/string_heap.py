@@ -0,0 +1,120 @@
+import os
+import mmap
+from array import array
+
+import numpy as np
+
+"""
+    A string heap stores a list of strings as one UTF-8 encoded file plus
+    an array of offsets into it. Both files are memory mapped when read,
+    so opening a heap is instant and its pages are shared by every process
+    which has it open.
+
+    For a heap with prefix p the files are p.heap and p.offsets.npy.
+"""
+
+class StringHeapWriter:
+    """Appends strings to a heap on disk one at a time."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.heap = open(prefix + ".heap", "wb")
+        # array keeps the offsets compact while the heap is being written
+        self.offsets = array('q', [0])
+
+    def append(self, s):
+        """
+            Appends a string to the heap.
+
+            @param: s, the string to append
+            @return: the index of the string in the heap
+        """
+        b = s.encode('utf-8')
+        self.heap.write(b)
+        self.offsets.append(self.offsets[-1] + len(b))
+        return len(self.offsets) - 2
+
+    def close(self):
+        self.heap.close()
+        np.save(self.prefix + ".offsets.npy", np.frombuffer(self.offsets, dtype=np.int64))
+
+def write_string_heap(strings, prefix):
+    """
+        Writes a list of strings to a heap.
+
+        @param: strings, iterable of strings
+        @param: prefix, path prefix of the heap files
+        @return: the number of strings written
+    """
+    writer = StringHeapWriter(prefix)
+    for s in strings:
+        writer.append(s)
+    writer.close()
+    return len(writer.offsets) - 1
+
+class StringHeap:
+    """Read only, memory mapped view of a heap written by StringHeapWriter."""
+
+    def __init__(self, prefix):
+        self.offsets = np.load(prefix + ".offsets.npy", mmap_mode='r')
+        with open(prefix + ".heap", "rb") as f:
+            # mmap refuses empty files
+            if os.fstat(f.fileno()).st_size == 0:
+                self.heap = b""
+            else:
+                self.heap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        """
+            @param: i, index of the string
+            @return: the UTF-8 encoded bytes of the ith string
+        """
+        return self.heap[int(self.offsets[i]):int(self.offsets[i+1])]
+
+    def __getitem__(self, i):
+        return self.raw(i).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class EncodedStrings:
+    """
+        Sequence over the UTF-8 bytes of the strings of a sorted heap, to
+        binary search it with bisect. UTF-8 bytes sort like the strings.
+    """
+
+    def __init__(self, heap):
+        self.heap = heap
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __getitem__(self, i):
+        return self.heap.raw(i)
+
+class MapView:
+    """Read only dict interface over a batched lookup function of a store."""
+
+    def __init__(self, lookup_many):
+        """
+            @param: lookup_many, function from a list of keys to the list of
+                    their values, None for keys which aren't in the store
+        """
+        self.lookup_many = lookup_many
+
+    def __getitem__(self, key):
+        value = self.lookup_many([key])[0]
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.lookup_many([key])[0]
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self.lookup_many([key])[0] is not None
@@ -0,0 +1,118 @@
+import os
+import json
+import bisect
+import logging
+
+import numpy as np
+
+from .string_heap import write_string_heap, StringHeap, EncodedStrings, MapView
+
+"""
+    Dictionary between Wikipedia page ids and titles.
+
+    Every distinct title is stored once in a string heap in sorted order,
+    titles are found with a binary search over the heap and ids with a
+    binary search over a sorted array. Everything is memory mapped, so
+    loading the dictionary is instant and the pages are shared between the
+    processes using it, unlike the pickled pair of dicts it replaces.
+
+    Layout of a dictionary directory:
+        meta.json
+        titles.heap, titles.offsets.npy   sorted distinct titles
+        title_ids.npy                     int64 page id of each title, -1 if none
+        ids.npy                           sorted int64 page ids
+        id_titles.npy                     int64 index of the title of each id
+"""
+
+def build_title_dictionary(id2title, title2id, outdir):
+    """
+        Builds the dictionary. The two directions are kept separately since
+        the maps they come from needn't be inverses of each other.
+
+        @param: id2title, dict of page id to title
+        @param: title2id, dict of title to page id
+        @param: outdir, directory to write the dictionary to
+        @return: the number of titles
+    """
+    def to_id(wid):
+        try:
+            return int(wid)
+        except (TypeError, ValueError):
+            return None
+
+    titles = sorted(set(id2title.values()) | set(title2id))
+    positions = {title: i for i, title in enumerate(titles)}
+    title_ids = np.full(len(titles), -1, dtype=np.int64)
+    for title, wid in title2id.items():
+        wid = to_id(wid)
+        if wid is not None:
+            title_ids[positions[title]] = wid
+    pairs = sorted((wid, positions[title]) for wid, title in
+                   ((to_id(wid), title) for wid, title in id2title.items()) if wid is not None)
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    write_string_heap(titles, os.path.join(outdir, "titles"))
+    np.save(os.path.join(outdir, "title_ids.npy"), title_ids)
+    np.save(os.path.join(outdir, "ids.npy"), np.asarray([p[0] for p in pairs], dtype=np.int64))
+    np.save(os.path.join(outdir, "id_titles.npy"), np.asarray([p[1] for p in pairs], dtype=np.int64))
+    with open(os.path.join(outdir, "meta.json"), "w") as f:
+        json.dump({"num_titles": len(titles), "num_ids": len(pairs)}, f)
+    logging.info("wrote title dictionary with %d titles and %d ids to %s", len(titles), len(pairs), outdir)
+    return len(titles)
+
+class TitleDictionary:
+    """Read only view of a dictionary written by build_title_dictionary."""
+
+    def __init__(self, directory):
+        self.titles = StringHeap(os.path.join(directory, "titles"))
+        self.title_ids = np.load(os.path.join(directory, "title_ids.npy"), mmap_mode='r')
+        self.ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode='r')
+        self.id_titles = np.load(os.path.join(directory, "id_titles.npy"), mmap_mode='r')
+        self._encoded = EncodedStrings(self.titles)
+        # dict like views, used where the pickled maps used to be
+        self.id2title = MapView(self.ids_to_titles)
+        self.title2id = MapView(self.titles_to_ids)
+
+    def titles_to_ids(self, titles):
+        """
+            @param: titles, sequence of titles
+            @return: list with the page id of each title as a string, None
+                     if the title isn't in the dictionary
+        """
+        out = []
+        for title in titles:
+            key = title.encode('utf-8')
+            i = bisect.bisect_left(self._encoded, key)
+            if i < len(self._encoded) and self._encoded[i] == key and self.title_ids[i] >= 0:
+                out.append(str(self.title_ids[i]))
+            else:
+                out.append(None)
+        return out
+
+    def ids_to_titles(self, ids):
+        """
+            @param: ids, sequence of page ids as ints or strings
+            @return: list with the title of each id, None if the id isn't in
+                     the dictionary
+        """
+        keys = np.empty(len(ids), dtype=np.int64)
+        for i, wid in enumerate(ids):
+            try:
+                keys[i] = int(wid)
+            except (TypeError, ValueError):
+                keys[i] = -1
+        if len(self.ids) == 0:
+            return [None] * len(keys)
+        pos = np.minimum(np.searchsorted(self.ids, keys), len(self.ids) - 1)
+        found = self.ids[pos] == keys
+        return [self.titles[int(t)] if f else None for t, f in zip(self.id_titles[pos], found)]
+
+if __name__=="__main__":
+    import sys
+    import pickle
+    logging.basicConfig(format=':%(levelname)s: %(message)s', level=logging.INFO)
+    # python -m utils.title_dictionary enwiki-20170520.id2t.pkl outdir
+    with open(sys.argv[1], "rb") as f:
+        id2title, title2id = pickle.load(f)[:2]
+    build_title_dictionary(id2title, title2id, sys.argv[2])
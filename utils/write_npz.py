@@ -4,11 +4,19 @@ import csv
 import shutil
 import numpy as np
 
-from io_utils import load_pkl, get_wid_mid_map, outlinks, id_to_title_map
-from data_utils import get_num_freebase_rel, count_outlinks
+from utils.outlinks_graph import off_diagonal
+from utils.resources import registry
+from utils.sparse_features import coo_arrays
 
+# run from the root of the repo with
+# python -m utils.write_npz datadir year [sparse] [paths]
 year = sys.argv[2]
 npz_dir = sys.argv[1]+"/npz/"+year+"/"
+# pass "sparse" after the year to store the pairwise features as COO
+sparse = "sparse" in sys.argv[3:]
+# pass "paths" after the year to add the typed and two hop Freebase features
+# of the "freebase_paths" resource to the pairwise features
+paths = "paths" in sys.argv[3:]
 try:
     shutil.rmtree(npz_dir)
 except:
@@ -16,8 +24,7 @@ except:
 os.mkdir(npz_dir)
 
 
-outlinks_file = "/shared/preprocessed/cddunca2/wikipedia/outlinks.t2t"
-outlinks_map = outlinks(outlinks_file)
+registry.configure(freebase_relations="resources/freebase_relations/")
 
 # Create dictionary of documents to list of entity lists --Sameer
 # Maps mention id to list of candidates.
@@ -65,7 +72,6 @@ def populate_maps_from_file(files_entities_mentions):
                 ments_cands_dict[m] = c
 
 populate_maps_from_file(data_dir+"files_entities_mentions.txt")
-wiki_mid_dict = get_wid_mid_map()
 
 unary_features = {}
 with open(data_dir+'/preds/preds.txt', 'r', encoding="utf8") as unary_file:
@@ -111,23 +117,15 @@ def read_and_pad_npy(file_name):
                  between candidate entities in the document.
     """
     mentions = files_ments_dict[file_name]
-    m = len(mentions)
-    id2t_map = id_to_title_map()
-    hyperlinks_counts = np.zeros((m, m-1, 30, 30))
-    for i, ment1 in enumerate(mentions):
-        for j, ment2 in enumerate(mentions):
-            if j != i:
-                for k, wiki_id1 in enumerate(ments_cands_dict[ment1]):
-                    for l, wiki_id2 in enumerate(ments_cands_dict[ment2]):
-                        try:
-                            t1 = id2t_map[wiki_id1]
-                            t2 = id2t_map[wiki_id2]
-                            hyperlinks_counts[i,j-1,k,l] = \
-                                float(count_outlinks(t1,t2,outlinks_map)) + float(count_outlinks(t2,t1,outlinks_map))
-                        except:
-                            import pdb
-                            pdb.set_trace()
-    return hyperlinks_counts 
+    candidates = []
+    for ment in mentions:
+        wiki_ids = ments_cands_dict[ment][:30]
+        titles = registry.get("titles").ids_to_titles(wiki_ids)
+        if None in titles:
+            raise KeyError(wiki_ids[titles.index(None)])
+        candidates.append(titles)
+    hyperlinks_counts = registry.get("outlinks").document_link_counts(candidates, 30)
+    return off_diagonal(hyperlinks_counts).astype(np.float64)
 
 def read_and_pad_freebase(file_name):
     """
@@ -141,24 +139,26 @@ def read_and_pad_freebase(file_name):
         @return: a numpy matrix which represents the number of relations
                  between candidate entities in the document.
     """
-    #TODO: move this out of here
-    fb_rel_map = load_pkl("resources/freebase_relations.pkl")
     mentions = files_ments_dict[file_name]
-    m = len(mentions)
-
-    freebase_counts = np.zeros((m, m-1, 30, 30))
-    for i, ment1 in enumerate(mentions):
-        for j, ment2 in enumerate(mentions):
-            if j != i:
-                for k, wiki_id1 in enumerate(ments_cands_dict[ment1]):
-                    for l, wiki_id2 in enumerate(ments_cands_dict[ment2]):
-                        if wiki_id1 in wiki_mid_dict and wiki_id2 in wiki_mid_dict:
-                            mid1 = wiki_mid_dict[wiki_id1]
-                            mid2 = wiki_mid_dict[wiki_id2]
-                            id_tuple = (mid1,mid2)
-                            freebase_counts[i,j-1,k,l] = \
-                                float(get_num_freebase_rel(id_tuple,fb_rel_map))
-    return freebase_counts
+    candidates = [ments_cands_dict[ment] for ment in mentions]
+    freebase_counts = registry.get("freebase_relations").tensor(candidates, 30)
+    return off_diagonal(freebase_counts).astype(np.float64)
+
+def read_and_pad_freebase_paths(file_name):
+    """
+        Creates an mx(m-1)x30x30xF matrix of the Freebase relatedness features
+        between candidates of different mentions in file_name: the number of
+        direct relations, the number of two hop paths and the number of
+        relations of each type, see freebase_paths.FreebasePaths.features.
+
+        @param: file_name, the name of the file in the corpus for which to
+                           create the matrix.
+        @return: a numpy matrix of the relatedness features
+    """
+    mentions = files_ments_dict[file_name]
+    candidates = [ments_cands_dict[ment] for ment in mentions]
+    path_features = registry.get("freebase_paths").tensor(candidates, 30)
+    return off_diagonal(path_features).astype(np.float64)
 
 # TODO: replace this with something...
 """
@@ -201,6 +201,8 @@ for fname in unary_features:
     freebase_counts = read_and_pad_freebase(fname)
     assert(hyperlink_counts.shape == freebase_counts.shape)
     pairwise_features = np.stack((hyperlink_counts, freebase_counts), axis=-1)
+    if paths:
+        pairwise_features = np.concatenate((pairwise_features, read_and_pad_freebase_paths(fname)), axis=-1)
     #get unary for each mention (in correct order)
     single_arr = []
     counts_dict = {} 
@@ -230,6 +232,12 @@ for fname in unary_features:
             print("gold: ", gold)
             print("gold.astype(np.int64): ", gold.astype(np.int64))
 
-            np.savez(npz_dir + fname + '.npz', single=single, pair=pairwise_features, truth=gold.astype(np.int64))
+            if sparse:
+                np.savez(npz_dir + fname + '.npz', single=single, **coo_arrays('pair', pairwise_features),
+                         truth=gold.astype(np.int64))
+            else:
+                np.savez(npz_dir + fname + '.npz', single=single, pair=pairwise_features, truth=gold.astype(np.int64))
         else:
             print("File not accepted.")
+
+registry.report()
@@ -2,6 +2,8 @@ import tensorflow as tf
 import numpy as np
 import os
 
+from sparse_features import load_coo, load_dense, pair_features
+
 def _int64_feature(value):
   return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
 
@@ -32,8 +34,31 @@ def decode(serialized_example):
     truth = features['truth'].values
     return single, pair, truth
 
-def convert_to(npz_names, tfrecord_name):
-    """Converts a dataset to tfrecords."""
+def decode_sparse(serialized_example):
+    """Like decode for examples written with sparse=True, the pairwise
+    features are returned as a tf.SparseTensor."""
+    features = tf.parse_single_example(
+            serialized_example,
+            features={
+                'single_shp': tf.FixedLenFeature([3], dtype=tf.int64),
+                'single': tf.VarLenFeature(tf.float32),
+                'pair_shp': tf.FixedLenFeature([5], dtype=tf.int64),
+                'pair_indices': tf.VarLenFeature(tf.int64),
+                'pair_values': tf.VarLenFeature(tf.float32),
+                'truth':  tf.VarLenFeature(tf.int64)
+                }
+            )
+    single = tf.reshape(features['single'].values, features['single_shp'])
+    pair = tf.SparseTensor(indices=tf.reshape(features['pair_indices'].values, [-1, 5]),
+                           values=features['pair_values'].values,
+                           dense_shape=features['pair_shp'])
+    truth = features['truth'].values
+    return single, pair, truth
+
+def convert_to(npz_names, tfrecord_name, sparse=False):
+    """Converts a dataset to tfrecords. The npz files may hold the pairwise
+    features dense or sparse, see sparse_features. With sparse the
+    pairwise features are written as COO, to be read with decode_sparse."""
     single_raw = []
     single_shapes = []
     pair_raw = []
@@ -46,9 +71,14 @@ def convert_to(npz_names, tfrecord_name):
             single_raw.append(np.ravel(single))
             single_shapes.append(single.shape)
 
-            pair = data['pair']
-            pair_raw.append(np.ravel(pair))
-            pair_shapes.append(pair.shape)
+            if sparse:
+                indices, values, shape = load_coo(data, 'pair')
+                pair_raw.append((indices, values))
+                pair_shapes.append(shape)
+            else:
+                pair = load_dense(data, 'pair')
+                pair_raw.append(np.ravel(pair))
+                pair_shapes.append(pair.shape)
             
             truth.append(data['truth'])
 
@@ -56,16 +86,13 @@ def convert_to(npz_names, tfrecord_name):
 
     with tf.python_io.TFRecordWriter(tfrecord_name) as writer:
         for s_shp, s, p_shp, p, t in zip(single_shapes, single_raw, pair_shapes, pair_raw, truth):
-            example = tf.train.Example(
-                    features=tf.train.Features(
-                        feature={
-                            'single_shp': _int64_feature(list(s_shp)),
-                            'single': _float64_feature(s),
-                            'pair_shp': _int64_feature(list(p_shp)),
-                            'pair':   _float64_feature(p),
-                            'truth':  _int64_feature(t)
-                            })
-                        )
+            feature = {
+                'single_shp': _int64_feature(list(s_shp)),
+                'single': _float64_feature(s),
+                'truth':  _int64_feature(t)
+                }
+            feature.update(pair_features(p_shp, p, sparse))
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
             writer.write(example.SerializeToString())
    
 if __name__=="__main__":
@@ -77,6 +104,8 @@ if __name__=="__main__":
     #path = 'data/npz/'
     path = sys.argv[1]
     tfr_file = sys.argv[2] 
+    # pass "sparse" as the third argument to write the pairwise features as COO
+    sparse = len(sys.argv) > 3 and sys.argv[3] == "sparse"
     npz_names = [path + fname for fname in os.listdir(path)]
     #convert_to(npz_names, 'data/tfr/2009_training.tfrecord')
-    convert_to(npz_names, tfr_file)
+    convert_to(npz_names, tfr_file, sparse)